@@ -1,29 +1,51 @@
 # Importing necessary modules and packages
+import atexit
+import csv
+import hashlib
 import json
 import re
-from flask import Flask, render_template, jsonify, request, send_from_directory, redirect, url_for, flash, Response
+from flask import Flask, render_template, jsonify, request, send_from_directory, redirect, url_for, flash, Response, \
+    stream_with_context
 
 from requests import Timeout
 import db
+import items_io
+import layout
 import requests
+import wled
 import time
 import os
+from functools import partial
 from werkzeug.utils import secure_filename
 
 # Creating a Flask application instance
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 
-# Default Values
-app.brightness = 1
-app.delSegments = ""
-app.timeout = 5
-app.standbyColor = "#00ff00"
-app.locateColor = "#00ff00"
 app.config['UPLOAD_FOLDER'] = './images'
-app.previous_positions = []
 app.request_amount = 0
 
+hex_color_pattern = re.compile(r"#?[0-9a-fA-F]{6}")
+
+# Seconds a locate request waits for the ESP to take the new frame
+LOCATE_TIMEOUT = wled.INFO_TIMEOUT + 1
+
+# Rejected rows listed in the response of an import, the rest are only counted
+IMPORT_MAX_ERRORS = 100
+
+# Send a locate as one complete frame instead of clear, pause and highlight
+SINGLE_SHOT = os.getenv('WLED_SINGLE_SHOT', 'true').lower() in ('1', 'true', 'yes')
+
+# Bootstrap the database schema once and close pooled connections on shutdown
+db.init_db()
+atexit.register(db.close_pool)
+atexit.register(wled.shutdown)
+
+
+# Return the request thread's database connection to the pool
+@app.teardown_appcontext
+def release_db_connection(exception):
+    db.release_connection()
 
 
 @app.route('/proxy-image', methods=['GET'])
@@ -73,8 +95,11 @@ def upload_file():
 def tags():
     if request.method == 'GET':
         try:
+            etag = data_etag('items')
+            if etag in request.if_none_match:
+                return not_modified(etag)
             tag_data = db.get_all_tags()  # Fetch ESP data from the database
-            return jsonify(tag_data), 200
+            return with_etag(jsonify(tag_data), etag), 200
         except Exception as e:
             print(f"Error fetching Tag data: {e}")  # Log the error for debugging
             return jsonify({"error": "An error occurred fetching Tag data"}), 500
@@ -96,35 +121,37 @@ def get_unique_ips_from_database():
     return unique_ips_list
 
 
-def is_valid_url_or_ip(input_str):
-    ip_pattern = re.compile(r"\b(?:\d{1,3}\.){3}\d{1,3}\b")  # Simple IP address regex
-    url_pattern = re.compile(r"([a-zA-Z0-9-]+)\.([a-zA-Z]{2,})")
+def is_valid_hex_color(color):
+    return isinstance(color, str) and bool(hex_color_pattern.fullmatch(color))
 
-    if ip_pattern.match(input_str):
-        return True
 
-    return bool(url_pattern.match(input_str))
+def data_etag(*tables):
+    # Strong ETag from the change counters of the tables behind a response and the exact request,
+    # so it can be checked before any row is read
+    versions = db.get_table_versions(tables)
+    key = request.full_path + ''.join(f'|{table}:{versions.get(table)}' for table in tables)
+    return hashlib.sha1(key.encode()).hexdigest()
 
 
-def set_global_settings():
-    settings = db.read_settings()
+def with_etag(response, etag):
+    # Browsers revalidate on every load and get a 304 while the data is unchanged
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-    if settings:
-        app.brightness = settings['brightness'] / 100
-        app.timeout = settings['timeout']
 
-        colors = settings.get('colors')
-        # Assign colors
-        if isinstance(colors, list) and len(colors) >= 2:
-            app.standbyColor = colors[0]
-            app.locateColor = colors[1]
+def not_modified(etag):
+    return with_etag(Response(status=304), etag)
 
 
 @app.route('/api/settings', methods=['GET', 'POST'])
 def settings():
     if request.method == 'GET':
         # If the request method is GET, read data from the database and return as JSON
-        return jsonify(db.read_settings())
+        etag = data_etag('settings')
+        if etag in request.if_none_match:
+            return not_modified(etag)
+        return with_etag(jsonify(db.read_settings()), etag)
     elif request.method == 'POST':
         db.update_settings(request.get_json())  # Update settings in the database
         return jsonify({'success': True})
@@ -134,8 +161,11 @@ def settings():
 def esps():
     if request.method == 'GET':
         try:
+            etag = data_etag('esp')
+            if etag in request.if_none_match:
+                return not_modified(etag)
             esps_data = db.read_esp()  # Fetch ESP data from the database
-            return jsonify(esps_data), 200
+            return with_etag(jsonify(esps_data), etag), 200
         except Exception as e:
             print(f"Error fetching ESP data: {e}")  # Log the error for debugging
             return jsonify({"error": "An error occurred fetching ESP data"}), 500
@@ -151,6 +181,7 @@ def esps():
                 raise ValueError("Failed to write ESP settings")
 
             esp_data['id'] = id
+            sync_esp_transports()
             return jsonify(esp_data), 201
         except Exception as e:
             print(f"Error on writing ESP data: {e}")  # Log the error
@@ -160,6 +191,73 @@ def esps():
         return jsonify({"error": "Method not allowed"}), 405
 
 
+# Route to show the amount of successful WLED requests and how many reused a kept-alive connection
+@app.route('/api/esp/connections', methods=['GET'])
+def esp_connections():
+    return jsonify({'request_amount': app.request_amount, 'devices': wled.session_stats()})
+
+
+# Route to show which positions of an ESP grid are taken, by which items, and where items overlap
+@app.route('/api/esp/<id>/occupancy', methods=['GET'])
+def esp_occupancy(id):
+    etag = data_etag('items', 'esp')
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    esp = db.get_esp_settings(id)
+    if esp is None:
+        return jsonify({'error': 'ESP not found'}), 404
+
+    occupancy = db.get_occupancy(esp['id'])
+    size = int(esp['rows']) * int(esp['cols'])
+    occupied = sum(1 for position in occupancy if 1 <= position <= size)
+    return with_etag(jsonify({
+        'esp_id': esp['id'],
+        'rows': esp['rows'],
+        'cols': esp['cols'],
+        'bitmap': layout.occupancy_bitmap(esp, occupancy),
+        'occupied': occupied,
+        'free': size - occupied,
+        'items': {str(position): item_ids for position, item_ids in occupancy.items()},
+        'conflicts': {str(position): item_ids for position, item_ids in occupancy.items() if len(item_ids) > 1}
+    }), etag)
+
+
+# Route to find free positions on an ESP grid, e.g. ?count=3&together=true for three neighbouring bins
+@app.route('/api/esp/<id>/free', methods=['GET'])
+def esp_free_positions(id):
+    esp = db.get_esp_settings(id)
+    if esp is None:
+        return jsonify({'error': 'ESP not found'}), 404
+    count = max(1, request.args.get('count', 1, type=int))
+    together = request.args.get('together', 'false').lower() in ('1', 'true', 'yes')
+    positions = layout.find_free(esp, db.get_occupancy(esp['id']), count, together)
+    return jsonify({'esp_id': esp['id'], 'positions': positions})
+
+
+# Route to show the command queue depth and drop counters of every ESP
+@app.route('/api/esp/queues', methods=['GET'])
+def esp_queues():
+    return jsonify(wled.queue_stats())
+
+
+# Route to show whether every ESP is reachable, offline ESPs are skipped until their next probe
+@app.route('/api/esp/health', methods=['GET'])
+def esp_health():
+    return jsonify(wled.health_state())
+
+
+# Route to show which locate frames are cached as presets on every ESP
+@app.route('/api/esp/presets', methods=['GET'])
+def esp_presets():
+    return jsonify(wled.preset_stats())
+
+
+# Route to show the cached WLED device info of every ESP
+@app.route('/api/esp/info', methods=['GET'])
+def esp_info():
+    return jsonify(wled.info_cache_state())
+
+
 @app.route('/api/esp/<id>', methods=['GET', 'PUT', 'DELETE'])
 def handle_esp(id):
     if request.method == 'GET':
@@ -172,11 +270,35 @@ def handle_esp(id):
     elif request.method == 'PUT':
         esp_data = request.get_json()
 
+        # Forget the cached device info of the old and the new address
+        layout.invalidate(id)
+        old_esp = db.get_esp_settings(id)
+        if old_esp:
+            if old_esp.get('transport', 'http') != 'http':
+                # Release the ESP from UDP realtime mode before its transport may change
+                wled.submit(old_esp['esp_ip'], partial(send_request, old_esp['esp_ip'], {"live": False}))
+            wled.invalidate_info(old_esp['esp_ip'])
+            wled.close_session(old_esp['esp_ip'])
+            wled.preset_forget(old_esp['esp_ip'])
+            if esp_data.get('esp_ip') != old_esp['esp_ip']:
+                wled.forget_device(old_esp['esp_ip'])
         db.update_esp_settings(id, esp_data)
+        if esp_data.get('esp_ip'):
+            wled.invalidate_info(esp_data['esp_ip'])
+            wled.refresh_info([esp_data['esp_ip']])
+        sync_esp_transports()
         return jsonify({'success': True})
 
     elif request.method == 'DELETE':
+        layout.invalidate(id)
+        old_esp = db.get_esp_settings(id)
+        if old_esp:
+            wled.invalidate_info(old_esp['esp_ip'])
+            wled.close_session(old_esp['esp_ip'])
+            wled.preset_forget(old_esp['esp_ip'])
+            wled.forget_device(old_esp['esp_ip'])
         db.delete_esp_settings(id)
+        sync_esp_transports()
         return jsonify({'success': True})
 
 
@@ -184,19 +306,137 @@ def handle_esp(id):
 @app.route('/api/items', methods=['GET', 'POST'])
 def items():
     if request.method == 'GET':
-        items = db.read_items()
-        return jsonify(items)
+        fields = request.args.get('fields')
+        fields = [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+        after_id = request.args.get('after_id', type=int)
+        limit = request.args.get('limit', type=int)
+        # Only items carrying all of the given tags
+        tags = [tag.strip() for value in request.args.getlist('tags') for tag in value.split(',') if tag.strip()]
+
+        etag = data_etag('items')
+        if etag in request.if_none_match:
+            return not_modified(etag)
+
+        try:
+            # Without a cursor or limit the whole inventory is returned, like older clients expect.
+            # It is streamed from the database cursor instead of being built in memory first.
+            if after_id is None and limit is None:
+                rows = db.iter_items(fields, tags)
+                # The rows come from their own connection and the app context stays open while
+                # streaming, so give the pooled one back now instead of after the last chunk
+                db.release_connection()
+                return with_etag(Response(stream_with_context(items_io.json_array(rows)),
+                                          mimetype='application/json'), etag)
+
+            limit = max(1, min(limit or db.ITEMS_PAGE_LIMIT, db.ITEMS_PAGE_LIMIT_MAX))
+            # Fetch one extra row to find out whether another page follows
+            items = db.read_items(fields, after_id, limit + 1, tags)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        response = jsonify(items[:limit])
+        if len(items) > limit:
+            response.headers['X-Next-After-Id'] = str(items[limit - 1]['id'])
+        return with_etag(response, etag)
     elif request.method == 'POST':
         item = request.get_json()
         id = db.write_item(item)
         item['id'] = id
+        item['conflicts'] = db.get_position_conflicts(id)
         return jsonify(item)
 
 
+# Route to search items by name, link and tags on the server
+@app.route('/api/items/search', methods=['GET'])
+def search_items():
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', db.SEARCH_LIMIT, type=int)
+    if not query:
+        return jsonify([])
+    try:
+        return jsonify(db.search_items(query, limit))
+    except Exception as e:
+        print(f"Error searching items: {e}")  # Log the error for debugging
+        return jsonify({"error": "An error occurred searching items"}), 500
+
+
+# Route for the delta sync of clients keeping a local copy: items changed and deleted after a change number
+@app.route('/api/items/changes', methods=['GET'])
+def item_changes():
+    since = request.args.get('since', 0, type=int)
+    return jsonify(db.get_item_changes(since))
+
+
+# Route to add or remove stock of several items at once, e.g. {"adjustments": [{"id": 1, "delta": -2}]}
+@app.route('/api/items/stock', methods=['POST'])
+def item_stock():
+    data = request.get_json(silent=True)
+    adjustments = data.get('adjustments') if isinstance(data, dict) else data
+    if not isinstance(adjustments, list) or not adjustments:
+        return jsonify({'error': 'No adjustments given'}), 400
+    if not all(isinstance(entry, dict) and isinstance(entry.get('id'), int) and isinstance(entry.get('delta'), int)
+               for entry in adjustments):
+        return jsonify({'error': 'Every adjustment needs an integer id and delta'}), 400
+
+    try:
+        quantities, missing = db.adjust_stock((entry['id'], entry['delta']) for entry in adjustments)
+    except Exception as e:
+        print(f"Error adjusting stock: {e}")
+        return jsonify({'error': 'An error occurred adjusting stock'}), 500
+    return jsonify({'success': True, 'items': [{'id': item_id, 'quantity': quantity}
+                                               for item_id, quantity in quantities.items()], 'missing': missing})
+
+
+# Route to add many items at once from a CSV or JSON Lines upload (multipart 'file' or the raw body)
+@app.route('/api/items/import', methods=['POST'])
+def import_items():
+    upload = request.files.get('file')
+    file_format = items_io.detect_format(request.args.get('format'), upload.filename if upload else None,
+                                         request.content_type)
+    if file_format is None:
+        return jsonify({'error': f"Unknown format, use one of {', '.join(items_io.FORMATS)}"}), 400
+
+    # Multipart uploads are already spooled by werkzeug. A raw body is read into a temporary file
+    # first, so a slow upload doesn't hold the write lock of the import transaction.
+    stream = upload.stream if upload else items_io.spool(request.stream)
+    try:
+        imported, errors = db.import_items(items_io.parse_rows(stream, file_format))
+    except (ValueError, csv.Error) as e:
+        return jsonify({'error': f"Could not read the file: {e}"}), 400
+    except Exception as e:
+        print(f"Error importing items: {e}")
+        return jsonify({'error': 'An error occurred importing items'}), 500
+    finally:
+        if not upload:
+            stream.close()
+    return jsonify({'success': True, 'imported': imported, 'rejected': len(errors),
+                    'errors': errors[:IMPORT_MAX_ERRORS]})
+
+
+# Route to download all items as CSV, JSON Lines or a JSON array, streamed from the database cursor
+@app.route('/api/items/export', methods=['GET'])
+def export_items():
+    file_format = items_io.detect_format(request.args.get('format', 'csv'), formats=items_io.EXPORT_FORMATS)
+    if file_format is None:
+        return jsonify({'error': f"Unknown format, use one of {', '.join(items_io.EXPORT_FORMATS)}"}), 400
+
+    rows = db.iter_items(items_io.EXPORT_FIELDS)
+    db.release_connection()
+    if file_format == 'csv':
+        body, mimetype = items_io.export_csv(rows), 'text/csv'
+    elif file_format == 'json':
+        body, mimetype = items_io.json_array(rows), 'application/json'
+    else:
+        body, mimetype = items_io.export_jsonl(rows), 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=items.{file_format}'})
+
+
 # Route to handle GET, PUT, DELETE requests for a specific item
 @app.route('/api/items/<id>', methods=['GET', 'PUT', 'DELETE', 'POST'])
 def item(id):
-    item = db.get_item(id)
+    # Locating reads the item together with its ESP below
+    item = db.get_item(id) if request.method in ('GET', 'PUT') else None
     if request.method == 'GET':
         if item:
             return jsonify(item)
@@ -204,13 +444,18 @@ def item(id):
             return jsonify({'error': 'Item not found'}), 404
 
     elif request.method == 'PUT':
+        if item is None:
+            return jsonify({'error': 'Item not found'}), 404
         if request.headers.get('Update-Quantity') == 'true':
             db.update_item_quantity(id, request.get_json())
         elif request.headers.get('Update-Image') == 'true':
             db.update_item_image(id, request.get_json())
         else:
             db.update_item(id, request.get_json())
-        return jsonify(dict(item))
+        # Saving never fails on overlapping positions, the UI warns about them instead
+        response = dict(item)
+        response['conflicts'] = db.get_position_conflicts(id)
+        return jsonify(response)
 
     elif request.method == 'DELETE':
         db.delete_item(id)
@@ -218,73 +463,141 @@ def item(id):
     elif request.method == 'POST':
 
         if request.form.get('action') == 'locate':
-            if is_valid_url_or_ip(item['ip']):
-                ip = item['ip']
-            else:
-                ip = db.get_ip_by_name(item['ip'])
-            esp = db.get_esp_settings_by_ip(ip)
-            light(item['position'], ip, esp, item['quantity'])
-
-            return jsonify({'success': True})
+            # The item and its ESP layout in one indexed join
+            target = db.get_locate_target(id)
+            if target is None:
+                return jsonify({'error': 'Item not found'}), 404
+            esp = target['esp']
+            if esp is None:
+                return jsonify({'error': f"No ESP found for '{target['ip']}'"}), 404
+            ip = esp['esp_ip']
+            result = wled.wait_all({ip: light(target['position'], ip, esp, target['quantity'], label=target['id'])},
+                                   LOCATE_TIMEOUT)
+
+            return jsonify({'success': True, 'device': result[ip]})
         else:
             return jsonify({'error': 'Invalid action'}), 400
 
 
+def sync_esp_transports():
+    # Tell the WLED layer which ESPs to monitor and which get their frames over UDP
+    esps = [esp for esp in db.read_esp() if esp.get('esp_ip')]
+    wled.set_transports({esp['esp_ip']: esp.get('transport') for esp in esps})
+    wled.set_monitored(esp['esp_ip'] for esp in esps)
+
+
 def send_request(target_ip, data, timeout=0.2):
+    # Colour-only updates for ESPs using a UDP realtime transport are sent as a binary frame
+    result = wled.send_realtime(target_ip, data)
+    if result is not None:
+        if result['status'] == 'ok':
+            app.request_amount += 1
+        return result
+    if wled.get_transport(target_ip) != 'http':
+        # Leave realtime mode, otherwise the ESP keeps showing the last UDP frame
+        data = dict(data, live=False)
+
+    # Skip ESPs that are known to be offline until their next retry
+    if not wled.is_available(target_ip):
+        return {'status': 'offline', 'latency_ms': 0}
+
     url = f"http://{target_ip}/json/state"
+    start = time.monotonic()
 
     try:
-        response = requests.post(url, json=data, timeout=timeout)
+        response = wled.get_session(target_ip).post(url, json=data, timeout=timeout)
+        latency_ms = round((time.monotonic() - start) * 1000, 1)
+        wled.record_result(target_ip, True, latency_ms)
         # Check for successful response, and handle accordingly
 
         if response.status_code == 200:
             # Success
             app.request_amount += 1
+            return {'status': 'ok', 'latency_ms': latency_ms}
         else:
             # Handle other status codes (e.g., 404, 500, etc.) as needed
             print(f"Request failed with status code {response.status_code}")
-    except ConnectionError as e:
-        # Handle connection errors
-        print(f"Connection error: {e}")
+            return {'status': 'http_error', 'code': response.status_code, 'latency_ms': latency_ms}
     except Timeout as e:
         # Handle timeout errors
         print(f"Timeout error: {e}")
+        wled.record_result(target_ip, False, error=str(e))
+        return {'status': 'timeout', 'latency_ms': round((time.monotonic() - start) * 1000, 1)}
+    except requests.RequestException as e:
+        # Handle connection errors
+        print(f"Connection error: {e}")
+        wled.record_result(target_ip, False, error=str(e))
+        return {'status': 'error', 'error': str(e), 'latency_ms': round((time.monotonic() - start) * 1000, 1)}
 
 
 def get_total_leds(ip):
-    try:
-        response = requests.get(f"http://{ip}/json/info")
-        response.raise_for_status()
-        info = response.json()
-        return info['leds']['count']
-    except requests.RequestException as e:
-        print(f"Error fetching total LEDs: {e}")
-        return 1000  # Default value if the request fails
-
+    # LED count from the device info cache, falls back to 1000 if the ESP was never reachable
+    return wled.get_info(ip)['leds']
+
+
+def send_cached_frame(ip, payload, key, label=None):
+    # Recall a frame that was saved as a preset on the ESP instead of uploading all of its LEDs again
+    if not wled.PRESET_CACHE or wled.get_transport(ip) != 'http':
+        return send_request(ip, payload)
+
+    preset = wled.preset_lookup(ip, key)
+    if preset is not None:
+        result = send_request(ip, {"ps": preset})
+        if result['status'] == 'ok':
+            return result
+        wled.preset_forget(ip, key)
+        return send_request(ip, payload)
+
+    preset = wled.preset_claim(ip, key, label)
+    if preset is None:
+        return send_request(ip, payload)
+
+    # Show the frame, then store it as an API call preset ("o": true). A preset of the current
+    # state would not contain the per-LED "i" colours, so recalling it would lose the highlights.
+    result = send_request(ip, payload)
+    if result['status'] != 'ok':
+        wled.preset_forget(ip, key)
+        return result
+    name = f"Locate {label}" if label is not None else "Locate"
+    saved = send_request(ip, dict(payload, psave=preset, n=name, o=True))
+    if saved['status'] != 'ok':
+        wled.preset_forget(ip, key)
+    return result
+
+
+def set_leds(led_indices, color, off_color, ip, testing=False, timeout=0, single_shot=None, label=None,
+             brightness=1):
+    # Runs on the ESP's worker thread (see light()), so the LED state of the ESP is not shared.
+    # Settings are passed in by the request thread, the worker does not touch the database.
+    state = wled.device_state(ip)
+    if not wled.is_available(ip):
+        return {'status': 'offline', 'latency_ms': 0}
+    if single_shot is None:
+        single_shot = SINGLE_SHOT
+
+    # A new locate replaces the pending auto-off of this ESP
+    wled.cancel_scheduled(ip)
 
-def set_leds(led_indices, color, off_color, ip, testing=False):
     # Get the total number of LEDs from the WLED API
     total_leds = get_total_leds(ip)
 
-    # Clear existing segments if they exist
-    if app.delSegments:
-        off_data = {"on": False, "bri": 0, "transition": 0, "mainseg": 0, "seg": []}
-        send_request(ip, off_data)
-        time.sleep(0.3)
-    else:
-        # Turn off all LEDs with the off_color
-        payload = {
-            "on": False,
-            "seg": {"i": []}
-        }
-        send_request(ip, payload)
-        time.sleep(0.3)
+    # Clear existing segments first, unless the whole frame is sent at once
+    if not single_shot:
+        if state['cleared']:
+            off_data = {"on": False, "bri": 0, "transition": 0, "mainseg": 0, "seg": []}
+            send_request(ip, off_data)
+            time.sleep(0.3)
+        else:
+            # Turn off all LEDs with the off_color
+            payload = {
+                "on": False,
+                "seg": {"i": []}
+            }
+            send_request(ip, payload)
+            time.sleep(0.3)
 
-    # Initialize payload for turning off LEDs (if needed)
-    off_payload = {
-        "on": True,
-        "seg": {"i": []}
-    }
+    # Payload painting the whole strip in the standby colour
+    off_payload = wled.fill_payload(total_leds, off_color)
 
     # Convert the LED indices from a string to a list of integers if necessary
     if isinstance(led_indices, str):
@@ -293,120 +606,146 @@ def set_leds(led_indices, color, off_color, ip, testing=False):
         led_indices_new = list(map(int, led_indices))
 
     # Check if the new positions are different from the previous ones
-    if app.previous_positions != led_indices_new:
-        # Initialize payload for turning on LEDs with the desired color
-        on_payload = {
-            "on": True,
-            "seg": {"i": []}
-        }
-
+    if state['previous_positions'] != led_indices_new:
         # Light up the current LEDs with the desired color
-        for i in led_indices_new:
-            on_payload["seg"]["i"].extend([i, color[1:]])
+        if single_shot:
+            # Standby colour everywhere and the highlights on top, in a single state update
+            bri = round(255 * brightness)
+            on_payload = wled.frame_payload(total_leds, off_color, {led: color for led in led_indices_new}, bri=bri)
+            key = (total_leds, off_color, color, bri, tuple(led_indices_new))
+            result = send_cached_frame(ip, on_payload, key, label)
+        else:
+            on_payload = wled.led_payload(led_indices_new, color)
 
-        # Send the API request to set the colors of the LEDs
-        send_request(ip, on_payload)
+            # Send the API request to set the colors of the LEDs
+            result = send_request(ip, on_payload)
 
         # Update the previous positions to the current ones
-        app.previous_positions = led_indices_new
+        state['previous_positions'] = led_indices_new
     else:
         # If the positions are the same, turn off all LEDs
-        for i in range(total_leds):
-            off_payload["seg"]["i"].extend([i, off_color[1:]])
-        send_request(ip, off_payload)
-        app.previous_positions = []  # Reset previous positions
-        app.timeout = 0  # Reset timeout
-
-    # Handle timeout and turn off LEDs after delay if needed
-    if app.timeout > 0 and not testing:
-        time.sleep(app.timeout)
-        for i in range(total_leds):
-            off_payload["seg"]["i"].extend([i, off_color[1:]])
-        send_request(ip, off_payload)
-        app.previous_positions = []  # Reset previous positions
-    elif testing:
-        time.sleep(app.timeout + 3)  # Ensure a minimum delay during testing
-
-    # Update global delSegments to include the off_payload segment
-    app.delSegments = off_payload
-
-
-def light(positions, ip, esp, quantity=1, testing=False):
-    # Set global settings
-    set_global_settings()
+        result = send_request(ip, off_payload)
+        state['previous_positions'] = []  # Reset previous positions
+        timeout = 0  # No auto-off needed
+
+    # Schedule turning the LEDs off after the timeout instead of waiting in the request thread
+    if timeout > 0 and not testing:
+        wled.schedule(ip, timeout, lambda: turn_off_after_timeout(ip, off_payload))
+
+    # The strip has been painted by us, later locates only need a short clear
+    state['cleared'] = True
+    return result
+
+
+def turn_off_after_timeout(ip, off_payload):
+    send_request(ip, off_payload)
+    wled.device_state(ip)['previous_positions'] = []  # Reset previous positions
+
+
+def light(positions, ip, esp, quantity=1, testing=False, label=None):
+    current_settings = db.get_settings()
     positions_list = position_optimization(sorted(json.loads(positions)), esp)
-    if testing:
-        set_leds(positions_list, app.locateColor, app.standbyColor, ip, testing)
-    elif quantity <= 0:
-        set_leds(positions_list, "#FF0000", app.standbyColor, ip, testing)
+    if testing or quantity > 0:
+        color = current_settings.locate_color
     else:
-        set_leds(positions_list, app.locateColor, app.standbyColor, ip, testing)
+        color = "#FF0000"
+    # Queue the LED update on the ESP's worker, a newer locate supersedes it while it is still waiting
+    wled.cancel_scheduled(ip)
+    return wled.submit(ip, partial(set_leds, positions_list, color, current_settings.standby_color, ip, testing,
+                                    current_settings.timeout, label=label,
+                                    brightness=current_settings.brightness))
+
+
+@app.route('/api/locate', methods=['POST'])
+def locate_items():
+    # Light up a whole pick list at once: items by id, by tags or by search query.
+    # Every ESP receives exactly one frame containing all of its items.
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    item_ids = data.get('ids') or []
+    tags = data.get('tags') or []
+    query = data.get('q') or ''
+    colors = data.get('colors') or {}
+
+    if isinstance(tags, str):
+        tags = [tag.strip() for tag in tags.split(',') if tag.strip()]
+    elif not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        return jsonify({'error': 'tags must be a string or a list of tags'}), 400
+    if not isinstance(query, str):
+        return jsonify({'error': 'q must be a string'}), 400
+    query = query.strip()
+    if not isinstance(colors, dict):
+        return jsonify({'error': 'colors must be an object of item id to colour'}), 400
+    colors = {str(item_id): color for item_id, color in colors.items()}
+    if not isinstance(item_ids, list) or not all(isinstance(item_id, int) for item_id in item_ids):
+        return jsonify({'error': 'ids must be a list of item ids'}), 400
+    if not any([item_ids, tags, query]):
+        return jsonify({'error': 'No ids, tags or q given'}), 400
+    if not all(is_valid_hex_color(color) for color in colors.values()):
+        return jsonify({'error': 'Invalid color, use #RRGGBB'}), 400
+
+    current_settings = db.get_settings()
+    targets = db.get_locate_targets(item_ids, tags, query)
+
+    # Group the LEDs to light by ESP, later items win on shared LEDs
+    frames = {}
+    located = []
+    unresolved = []
+    for target in targets:
+        esp = target['esp']
+        # Items without a known ESP or a readable position cannot be lit, the others still are
+        positions = db.parse_positions(target['position'])
+        if esp is None or not positions:
+            unresolved.append(target['id'])
+            continue
+        default_color = "#FF0000" if target['quantity'] is not None and target['quantity'] <= 0 else current_settings.locate_color
+        color = colors.get(str(target['id']), default_color)
+        leds = position_optimization(sorted(positions), esp)
+        frames.setdefault(esp['esp_ip'], {}).update((led, color) for led in leds)
+        located.append(target['id'])
+
+    standby_color = current_settings.standby_color
+    brightness = round(255 * current_settings.brightness)
+    timeout = current_settings.timeout
+
+    def locate_on_device(ip):
+        wled.cancel_scheduled(ip)
+        wled.reset_device_state(ip)
+        total_leds = get_total_leds(ip)
+        result = send_request(ip, wled.frame_payload(total_leds, standby_color, frames[ip], bri=brightness))
+        if timeout > 0:
+            off_payload = wled.fill_payload(total_leds, standby_color)
+            wled.schedule(ip, timeout, lambda: turn_off_after_timeout(ip, off_payload))
+        return result
+
+    for ip in frames:
+        wled.cancel_scheduled(ip)
+    results = wled.dispatch(frames.keys(), locate_on_device, timeout=wled.COMMAND_TIMEOUT)
+    return jsonify({'success': True, 'located': located, 'unresolved': unresolved, 'devices': results})
 
 
 def position_optimization(positions, esp):
-    segments = []
-    rows = esp['rows']
-    columns = esp['cols']
-    start_y = esp['start_top'].lower()
-    start_x = esp['start_left'].lower()
-    orientation = esp['orientation'].lower()
-    serpentine = esp['serpentine'].lower()
-
-    # Ensure '1' values are interpreted as specific directions
-    if start_x == "1":
-        start_x = "right"
-    if start_y == "1":
-        start_y = "bottom"
-    if orientation == "1":
-        orientation = "vertical"
-    # Adjust the positions for serpentine
-    for pos in positions:
-        i = pos - 1
-
-        if orientation == "horizontal":
-            # Calculate row and column based on the index for horizontal orientation
-            row = i // columns
-            if serpentine == "1" and row % 2 == 1:
-                # Reverse the column for every other row (serpentine effect)
-                column = columns - 1 - (i % columns)
-            else:
-                column = i % columns
-        else:  # Vertical orientation
-            column = i // rows
-            if serpentine == "1" and column % 2 == 1:
-                # Reverse the row for every other column (serpentine effect)
-                row = rows - 1 - (i % rows)
-            else:
-                row = i % rows
-
-        # Adjust for starting positions
-        if start_x == "right":
-            column = columns - 1 - column
-        if start_y == "bottom":
-            row = rows - 1 - row
-
-        # Calculate the LED number
-        led_number = row * columns + column
-        # Append the calculated segment
-        segments.append(led_number)
-    print(segments)
-
-    return segments
+    # Gather the LED numbers from the ESP's precompiled position table
+    return layout.translate(positions, esp)
 
 
 
 @app.route('/test_lights', methods=['POST'])
 def test_lights():
-    set_global_settings()
     lights_list = request.get_json()
     for ip, positions in lights_list.items():
         # Validate positions list
         if not positions or not all(isinstance(pos, int) for pos in positions):
             return {'error': 'Invalid positions list'}, 400
-        positions_json = json.dumps(positions)
+
+    futures = {}
+    for ip, positions in lights_list.items():
         esp = db.get_esp_settings_by_ip(ip)
-        light(positions_json, ip, esp, 1, True)
-    return {'status': 'Lights controlled'}
+        futures[ip] = light(json.dumps(positions), ip, esp, 1, True)
+
+    results = wled.wait_all(futures, LOCATE_TIMEOUT)
+    return {'status': 'Lights controlled', 'devices': results}
 
 
 def hex_to_rgb(hex_color):
@@ -432,15 +771,17 @@ def hex_to_rgb(hex_color):
 
 @app.route('/led/on', methods=['GET'])
 def turn_led_on():
-    set_global_settings()
-    app.previous_positions = []  # Reset previous positions
+    current_settings = db.get_settings()
     if request.method == 'GET':
         ips = get_unique_ips_from_database()
-        for ip in ips:
+
+        def led_on(ip):
+            wled.cancel_scheduled(ip)
+            wled.reset_device_state(ip)
             total_leds = get_total_leds(ip)
             on_data = {
                 "on": True,
-                "bri": app.brightness,
+                "bri": current_settings.brightness,
                 "transition": 5,
                 "mainseg": 0,
                 "seg": [
@@ -455,7 +796,7 @@ def turn_led_on():
                         "frz": False,
                         "cct": 127,
                         "set": 0,
-                        "col": [hex_to_rgb(app.standbyColor)],
+                        "col": [hex_to_rgb(current_settings.standby_color)],
                         "fx": 0,
                         "sx": 128,
                         "ix": 128,
@@ -489,16 +830,20 @@ def turn_led_on():
                     {"stop": 0}
                 ]
             }
-            send_request(ip, on_data)
-        return jsonify({'success': True})
+            return send_request(ip, on_data)
+
+        results = wled.dispatch(ips, led_on, timeout=wled.COMMAND_TIMEOUT)
+        return jsonify({'success': True, 'devices': results})
 
 
 # Route to turn the LED off
 @app.route('/led/off', methods=['GET'])
 def turn_led_off():
     ips = get_unique_ips_from_database()
-    app.previous_positions = []  # Reset previous positions
-    for ip in ips:
+
+    def led_off(ip):
+        wled.cancel_scheduled(ip)
+        wled.reset_device_state(ip)
         total_leds = get_total_leds(ip)
         on_data = {
             "on": False,
@@ -526,19 +871,23 @@ def turn_led_off():
                 {"stop": 0}
             ]
         }
-        send_request(ip, on_data)
-    return jsonify({'success': True})
+        return send_request(ip, on_data)
+
+    results = wled.dispatch(ips, led_off, timeout=wled.COMMAND_TIMEOUT)
+    return jsonify({'success': True, 'devices': results})
 
 
 # Route to turn the LED to Party
 @app.route('/led/party', methods=['GET'])
 def turn_led_party():
-    app.previous_positions = []  # Reset previous positions
-    set_global_settings()
+    current_settings = db.get_settings()
     if request.method == 'GET':
         ips = get_unique_ips_from_database()
-        for ip in ips:
-            party_data = {"on": True, "bri": round(255 * app.brightness), "transition": 5, "mainseg": 0, "seg": [
+
+        def led_party(ip):
+            wled.cancel_scheduled(ip)
+            wled.reset_device_state(ip)
+            party_data = {"on": True, "bri": round(255 * current_settings.brightness), "transition": 5, "mainseg": 0, "seg": [
                 {"id": 0, "grp": 1, "spc": 0, "of": 0, "on": True, "frz": False, "bri": 255, "cct": 127, "set": 0,
                  "col": [[255, 255, 255], [0, 0, 0], [0, 0, 0]], "fx": 9, "sx": 128, "ix": 128, "pal": 0, "c1": 128,
                  "c2": 128, "c3": 16},
@@ -557,8 +906,10 @@ def turn_led_party():
                 {"stop": 0},
                 {"stop": 0},
                 {"stop": 0}]}
-            send_request(ip, party_data)
-        return jsonify()
+            return send_request(ip, party_data)
+
+        results = wled.dispatch(ips, led_party, timeout=wled.COMMAND_TIMEOUT)
+        return jsonify({'success': True, 'devices': results})
 
 
 @app.route('/api/translations', methods=['GET'])
@@ -575,9 +926,11 @@ def get_languages():
         return jsonify({"error": "An error occurred fetching available languages"}), 500
 
 
-
-
-
+# Fetch the device info of all ESPs in the background, so the first locate does not wait for it
+wled.refresh_info(get_unique_ips_from_database())
+sync_esp_transports()
+wled.start_health_monitor()
+db.release_connection()
 
 
 if __name__ == '__main__':
@@ -1,21 +1,95 @@
 import json
 import os
+import queue
+import re
 import shutil
 import sqlite3
-from collections import Counter
+import threading
+import time
+from collections import namedtuple
 
 # Define the path for the combined database
 COMBINED_DATABASE = 'data/combined_data.db'
 
+# Maximum number of open connections kept by the pool
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+
+# Storage profile applied to every connection, each value can be overridden through the environment
+STORAGE_PROFILE = {
+    'journal_mode': os.getenv('DB_JOURNAL_MODE', 'WAL').upper(),
+    'synchronous': os.getenv('DB_SYNCHRONOUS', 'NORMAL').upper(),
+    'busy_timeout': int(os.getenv('DB_BUSY_TIMEOUT', 5000)),  # milliseconds
+    'cache_size': int(os.getenv('DB_CACHE_SIZE', -16000)),  # negative values are KiB
+    'mmap_size': int(os.getenv('DB_MMAP_SIZE', 134217728)),  # bytes
+    'wal_autocheckpoint': int(os.getenv('DB_WAL_AUTOCHECKPOINT', 1000)),  # pages
+}
+
+# Columns of the items table that can be requested through a field projection
+ITEM_FIELDS = ('id', 'name', 'link', 'image', 'position', 'quantity', 'ip', 'tags', 'esp_id', 'updated_seq')
+
+# Default and maximum page size for paginated item listings
+ITEMS_PAGE_LIMIT = 100
+ITEMS_PAGE_LIMIT_MAX = 1000
+
+# Items inserted per executemany() call of a bulk import
+IMPORT_BATCH = 500
+
+# Default and maximum number of hits returned by search_items()
+SEARCH_LIMIT = 50
+SEARCH_LIMIT_MAX = 500
+
+# Seconds between passive WAL checkpoints done in the background (0 disables the checkpointer)
+CHECKPOINT_INTERVAL = float(os.getenv('DB_CHECKPOINT_INTERVAL', 30))
+
+# Tables with a change counter, bumped by triggers on every write (see create_version_counters)
+VERSIONED_TABLES = ('items', 'esp', 'settings')
+
+# Seconds the cached settings are used before the version in the database is checked again
+SETTINGS_CHECK_INTERVAL = float(os.getenv('SETTINGS_CHECK_INTERVAL', 1))
+
+# Settings as used by the LED code, brightness is a fraction of 1
+Settings = namedtuple('Settings', 'brightness timeout standby_color locate_color light_mode language version')
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Connection pool state
+_pool = queue.LifoQueue()
+_pool_lock = threading.Lock()
+_pool_connections = []
+_pool_generation = 0
+_local = threading.local()
+_schema_ready = False
+
+# Set by create_combined_db() when the SQLite build supports the FTS5 search index
+fts_enabled = False
+
+# Settings cached in this process and when their version was last checked
+_settings = None
+_settings_checked_at = 0
+_settings_lock = threading.Lock()
+
+# Background checkpointer state
+_checkpoint_thread = None
+_checkpoint_stop = threading.Event()
+
 
 def create_combined_db():
     # Ensure the 'data' directory exists
     if not os.path.exists(os.path.dirname(COMBINED_DATABASE)):
         os.makedirs(os.path.dirname(COMBINED_DATABASE))  # Connect to the combined database
 
-    conn_combined = sqlite3.connect(COMBINED_DATABASE)
+    conn_combined = sqlite3.connect(COMBINED_DATABASE, timeout=STORAGE_PROFILE['busy_timeout'] / 1000)
     conn_combined.row_factory = sqlite3.Row
 
+    # The journal mode is stored in the database file, so it only has to be switched once
+    journal_mode = STORAGE_PROFILE['journal_mode']
+    if journal_mode in JOURNAL_MODES:
+        conn_combined.execute(f'PRAGMA journal_mode = {journal_mode}')
+    else:
+        print(f"Unknown journal mode '{journal_mode}', keeping the current one")
+    apply_storage_profile(conn_combined)
+
     # Create items table in the combined database
     conn_combined.execute('''
             CREATE TABLE IF NOT EXISTS items (
@@ -26,10 +100,18 @@ def create_combined_db():
                 position TEXT,
                 quantity INTEGER,
                 ip TEXT,
-                tags TEXT 
+                tags TEXT,
+                updated_seq INTEGER NOT NULL DEFAULT 0,
+                esp_id INTEGER REFERENCES esp(id) ON DELETE SET NULL
             )
         ''')
 
+    # Full-text index over the searchable item columns
+    create_search_index(conn_combined)
+
+    # Normalized tag index, one row per item and tag
+    create_tag_index(conn_combined)
+
     # Create esp table in the combined database
     conn_combined.execute('''
             CREATE TABLE IF NOT EXISTS esp (
@@ -41,7 +123,8 @@ def create_combined_db():
                 start_top TEXT,
                 start_left TEXT,
                 orientation TEXT,
-                serpentine TEXT
+                serpentine TEXT,
+                transport TEXT DEFAULT 'http'
             )
         ''')
 
@@ -53,7 +136,8 @@ def create_combined_db():
                 timeout INTEGER DEFAULT 5,
                 lightMode TEXT DEFAULT 'light',
                 colors TEXT DEFAULT '[#00ff00, #00ff00]',
-                language TEXT DEFAULT 'en'
+                language TEXT DEFAULT 'en',
+                version INTEGER DEFAULT 0
             )
         ''')
 
@@ -72,88 +156,764 @@ def create_combined_db():
     if 'language' not in columns:
         cursor.execute("ALTER TABLE settings ADD COLUMN language TEXT DEFAULT 'en'")
         conn_combined.commit()
+    if 'version' not in columns:
+        cursor.execute("ALTER TABLE settings ADD COLUMN version INTEGER DEFAULT 0")
+        conn_combined.commit()
+
+    # Check for the existence of the 'transport' column of the esp table
+    cursor.execute("PRAGMA table_info(esp)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'transport' not in columns:
+        cursor.execute("ALTER TABLE esp ADD COLUMN transport TEXT DEFAULT 'http'")
+        conn_combined.commit()
+
+    # Change counters used for the ETags of the read APIs
+    create_version_counters(conn_combined)
+
+    # Change numbers and tombstones of the items for the delta sync
+    create_change_log(conn_combined)
+
+    # Items reference their ESP by id, resolved from the free text 'ip' column
+    create_esp_reference(conn_combined)
+
+    # Reverse index of the grid positions taken by every item
+    create_position_index(conn_combined)
 
     return conn_combined
 
 
-# Function to read the data from the database
-def read_items():
-    conn = create_combined_db()
-    items = conn.execute('SELECT * FROM items').fetchall()
-    conn.close()
+def create_search_index(conn):
+    """Create the FTS5 index on items and the triggers keeping it in sync, returns False without FTS5."""
+    global fts_enabled
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'items_fts'").fetchone()
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+                name, link, tags,
+                content='items', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"Full-text search disabled, FTS5 is not available: {e}")
+        fts_enabled = False
+        return False
+
+    conn.executescript('''
+        CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, name, link, tags) VALUES (new.id, new.name, new.link, new.tags);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, name, link, tags)
+            VALUES ('delete', old.id, old.name, old.link, old.tags);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name, link, tags ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, name, link, tags)
+            VALUES ('delete', old.id, old.name, old.link, old.tags);
+            INSERT INTO items_fts (rowid, name, link, tags) VALUES (new.id, new.name, new.link, new.tags);
+        END;
+    ''')
+
+    # Index the items that existed before the search index was added
+    if not exists:
+        conn.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+    conn.commit()
+    fts_enabled = True
+    return True
+
+
+def parse_tags(raw_tags):
+    """Return the unique tags of an item's JSON 'tags' column, ignoring malformed values."""
+    if not raw_tags:
+        return []
+    if isinstance(raw_tags, str):
+        try:
+            raw_tags = json.loads(raw_tags)
+        except ValueError:
+            return []
+    if not isinstance(raw_tags, list):
+        return []
+    return list(dict.fromkeys(str(tag) for tag in raw_tags if tag not in (None, '')))
+
+
+def create_tag_index(conn):
+    """Create the item_tags table and fill it once from the JSON 'tags' column of existing items."""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'item_tags'").fetchone()
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS item_tags (
+                item_id INTEGER NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+                tag TEXT NOT NULL,
+                PRIMARY KEY (item_id, tag)
+            ) WITHOUT ROWID
+        ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_item_tags_tag ON item_tags (tag, item_id)')
+
+    # One-time migration from the JSON column
+    if not exists:
+        rows = conn.execute("SELECT id, tags FROM items WHERE tags IS NOT NULL AND tags != ''").fetchall()
+        conn.executemany('INSERT OR IGNORE INTO item_tags (item_id, tag) VALUES (?, ?)',
+                         [(row['id'], tag) for row in rows for tag in parse_tags(row['tags'])])
+    conn.commit()
+
+
+def create_version_counters(conn):
+    """Create the table_versions counters and the triggers bumping them on every insert, update and delete."""
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS table_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+    # Counters start at the current time in ms, so they never repeat when the database is recreated
+    start = int(time.time() * 1000)
+    conn.executemany('INSERT OR IGNORE INTO table_versions (name, version) VALUES (?, ?)',
+                     [(table, start) for table in VERSIONED_TABLES])
+    for table in VERSIONED_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            ''')
+    conn.commit()
+
+
+def create_change_log(conn):
+    """Add the updated_seq column and the tombstones of deleted items, numbering existing items once."""
+    # The item change sequence lives next to the table versions, seeded the same way
+    conn.execute("INSERT OR IGNORE INTO table_versions (name, version) VALUES ('item_seq', ?)",
+                 [int(time.time() * 1000)])
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(items)').fetchall()]
+    if 'updated_seq' not in columns:
+        conn.execute('ALTER TABLE items ADD COLUMN updated_seq INTEGER NOT NULL DEFAULT 0')
+    conn.execute("UPDATE items SET updated_seq = (SELECT version FROM table_versions WHERE name = 'item_seq') "
+                 "WHERE updated_seq = 0")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_items_updated_seq ON items (updated_seq)')
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS item_tombstones (
+                id INTEGER PRIMARY KEY,
+                deleted_seq INTEGER NOT NULL
+            )
+        ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_item_tombstones_seq ON item_tombstones (deleted_seq)')
+    conn.commit()
+
+
+def create_esp_reference(conn):
+    """Add the esp_id column to items, link existing items once and index the ESP lookups."""
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(items)').fetchall()]
+    if 'esp_id' not in columns:
+        conn.execute('ALTER TABLE items ADD COLUMN esp_id INTEGER REFERENCES esp(id) ON DELETE SET NULL')
+        _link_items_to_esp(conn)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_items_esp_id ON items (esp_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_esp_esp_ip ON esp (esp_ip)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_esp_name ON esp (name)')
+    conn.commit()
+
+
+def _link_items_to_esp(conn, where='1', params=(), seq=None):
+    # Point items at the ESP their 'ip' column refers to, a match on the IP wins over one on the name.
+    # Runs inside the caller's transaction, with seq the relinked items are also marked as changed.
+    resolve = ('COALESCE((SELECT id FROM esp WHERE esp_ip = items.ip ORDER BY id LIMIT 1), '
+               '(SELECT id FROM esp WHERE name = items.ip ORDER BY id LIMIT 1))')
+    if seq is None:
+        conn.execute(f'UPDATE items SET esp_id = {resolve} WHERE ({where}) AND esp_id IS NOT {resolve}', params)
+    else:
+        conn.execute(f'UPDATE items SET esp_id = {resolve}, updated_seq = ? WHERE ({where}) AND esp_id IS NOT {resolve}',
+                     [seq] + list(params))
+        # The relinked items share the change number, their positions now belong to another ESP
+        _index_item_positions(conn, 'updated_seq = ?', [seq])
+
+
+def parse_positions(raw_positions):
+    """Return the unique grid positions of an item's JSON 'position' column, ignoring malformed values."""
+    if isinstance(raw_positions, str):
+        try:
+            raw_positions = json.loads(raw_positions)
+        except ValueError:
+            return []
+    if not isinstance(raw_positions, list):
+        return []
+    positions = []
+    for position in raw_positions:
+        try:
+            positions.append(int(position))
+        except (TypeError, ValueError):
+            continue
+    return list(dict.fromkeys(positions))
+
+
+def create_position_index(conn):
+    """Create the item_positions table and fill it once from the items' JSON 'position' column."""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'item_positions'").fetchone()
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS item_positions (
+                esp_id INTEGER NOT NULL REFERENCES esp(id) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                item_id INTEGER NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+                PRIMARY KEY (esp_id, position, item_id)
+            ) WITHOUT ROWID
+        ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_item_positions_item ON item_positions (item_id)')
+
+    # One-time migration from the JSON column
+    if not exists:
+        _index_item_positions(conn)
+    conn.commit()
+
+
+def _index_item_positions(conn, where='1', params=()):
+    # Replace the indexed positions of the items matching where, runs inside the caller's transaction
+    rows = conn.execute(f'SELECT id, esp_id, position FROM items WHERE {where}', params).fetchall()
+    conn.executemany('DELETE FROM item_positions WHERE item_id = ?', [(row['id'],) for row in rows])
+    conn.executemany('INSERT OR IGNORE INTO item_positions (esp_id, position, item_id) VALUES (?, ?, ?)',
+                     [(row['esp_id'], position, row['id']) for row in rows if row['esp_id'] is not None
+                      for position in parse_positions(row['position'])])
+
+
+def _next_item_seq(conn):
+    # Take the next number of the item change sequence, runs inside the caller's transaction
+    conn.execute("UPDATE table_versions SET version = version + 1 WHERE name = 'item_seq'")
+    return conn.execute("SELECT version FROM table_versions WHERE name = 'item_seq'").fetchone()[0]
+
+
+def get_table_versions(tables):
+    """Return the change counters of the given tables as a {table: version} map."""
+    tables = list(tables)
+    placeholders = ', '.join('?' for _ in tables)
+    rows = get_connection().execute(f'SELECT name, version FROM table_versions WHERE name IN ({placeholders})',
+                                    tables).fetchall()
+    return {row['name']: row['version'] for row in rows}
+
+
+def _write_item_tags(conn, item_id, raw_tags):
+    # Replace the indexed tags of one item, runs inside the caller's transaction
+    conn.execute('DELETE FROM item_tags WHERE item_id = ?', [item_id])
+    conn.executemany('INSERT OR IGNORE INTO item_tags (item_id, tag) VALUES (?, ?)',
+                     [(item_id, tag) for tag in parse_tags(raw_tags)])
+
+
+def apply_storage_profile(conn):
+    """Apply the per-connection pragmas of STORAGE_PROFILE."""
+    synchronous = STORAGE_PROFILE['synchronous']
+    if synchronous in SYNCHRONOUS_MODES:
+        conn.execute(f'PRAGMA synchronous = {synchronous}')
+    conn.execute(f"PRAGMA busy_timeout = {int(STORAGE_PROFILE['busy_timeout'])}")
+    conn.execute(f"PRAGMA cache_size = {int(STORAGE_PROFILE['cache_size'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(STORAGE_PROFILE['mmap_size'])}")
+    # Committing threads only checkpoint themselves when the background checkpointer is not running
+    autocheckpoint = 0 if checkpointer_running() else int(STORAGE_PROFILE['wal_autocheckpoint'])
+    conn.execute(f"PRAGMA wal_autocheckpoint = {autocheckpoint}")
+
+
+def init_db():
+    """Bootstrap the schema once, before the first pooled connection is handed out."""
+    global _schema_ready
+    with _pool_lock:
+        if _schema_ready:
+            return
+        conn = create_combined_db()
+        wal_enabled = conn.execute('PRAGMA journal_mode').fetchone()[0].upper() == 'WAL'
+        conn.close()
+        _schema_ready = True
+    if wal_enabled and CHECKPOINT_INTERVAL > 0:
+        start_checkpointer()
+
+
+def _open_connection():
+    conn = sqlite3.connect(COMBINED_DATABASE, timeout=STORAGE_PROFILE['busy_timeout'] / 1000,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    apply_storage_profile(conn)
+    return conn
+
+
+def _checkpoint_loop(interval):
+    # Dedicated connection so checkpoints never take a slot from the request pool
+    conn = _open_connection()
+    try:
+        while not _checkpoint_stop.wait(interval):
+            try:
+                # PASSIVE checkpoints copy what they can without waiting on readers or writers
+                conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            except sqlite3.Error as e:
+                print(f"WAL checkpoint failed: {e}")
+        try:
+            # Fold the whole WAL back into the database file on shutdown
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        except sqlite3.Error as e:
+            print(f"WAL checkpoint failed: {e}")
+    finally:
+        conn.close()
+
+
+def start_checkpointer(interval=None):
+    """Start the background thread that periodically checkpoints the WAL."""
+    global _checkpoint_thread
+    if checkpointer_running():
+        return
+    _checkpoint_stop.clear()
+    _checkpoint_thread = threading.Thread(target=_checkpoint_loop, args=(interval or CHECKPOINT_INTERVAL,),
+                                          name='db-checkpoint', daemon=True)
+    _checkpoint_thread.start()
+
+
+def checkpointer_running():
+    """Whether the background checkpointer thread is running."""
+    return _checkpoint_thread is not None and _checkpoint_thread.is_alive()
+
+
+def stop_checkpointer():
+    """Stop the background checkpointer after a final checkpoint."""
+    global _checkpoint_thread
+    if _checkpoint_thread is None:
+        return
+    _checkpoint_stop.set()
+    _checkpoint_thread.join()
+    _checkpoint_thread = None
+
+
+def _acquire_connection():
+    init_db()
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+
+    with _pool_lock:
+        if len(_pool_connections) < POOL_SIZE:
+            conn = _open_connection()
+            _pool_connections.append(conn)
+            return conn
+
+    # Pool exhausted, wait until another thread releases its connection, but not forever
+    timeout = STORAGE_PROFILE['busy_timeout'] / 1000
+    try:
+        return _pool.get(timeout=timeout)
+    except queue.Empty:
+        raise sqlite3.OperationalError(f"No database connection became free within {timeout:g}s "
+                                       f"(pool size {POOL_SIZE})")
+
+
+def get_connection():
+    """Return the connection bound to the current thread, taking one from the pool if needed."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'generation', None) != _pool_generation:
+        conn = _acquire_connection()
+        _local.conn = conn
+        _local.generation = _pool_generation
+    return conn
+
+
+def release_connection():
+    """Give the current thread's connection back to the pool (called at the end of every request)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    if getattr(_local, 'generation', None) != _pool_generation:
+        # Connection belongs to a pool that has been closed in the meantime
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.ProgrammingError:
+        # Connection was closed by close_pool() in the meantime
+        return
+    _pool.put(conn)
+
+
+def close_pool():
+    """Close every pooled connection, used on shutdown."""
+    global _pool_generation
+    stop_checkpointer()
+    with _pool_lock:
+        _pool_generation += 1
+        for conn in _pool_connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                print(f"Error closing database connection: {e}")
+        _pool_connections.clear()
+        while True:
+            try:
+                _pool.get_nowait()
+            except queue.Empty:
+                break
+    _local.conn = None
+
+
+def reset_pool(database=None):
+    """Close the pool and forget the schema state, optionally pointing it at another database (for tests)."""
+    global COMBINED_DATABASE, _schema_ready
+    close_pool()
+    with _pool_lock:
+        if database is not None:
+            COMBINED_DATABASE = database
+        _schema_ready = False
+    invalidate_settings()
+
+
+def _item_columns(fields):
+    # Build a safe column list for a projection, the id is always included so items stay addressable
+    if not fields:
+        return '*'
+    unknown = [field for field in fields if field not in ITEM_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown item fields: {', '.join(unknown)}")
+    columns = ['id'] + [field for field in ITEM_FIELDS if field in fields and field != 'id']
+    return ', '.join(columns)
+
+
+# Function to read the data from the database, optionally projected, filtered by tags (all must match)
+# and paged by id (keyset pagination)
+def read_items(fields=None, after_id=None, limit=None, tags=None):
+    items = _items_cursor(fields, after_id, limit, tags).fetchall()
+    return [dict(item) for item in items]
+
+
+def _items_cursor(fields=None, after_id=None, limit=None, tags=None, conn=None):
+    # Run the items listing query, unknown fields raise ValueError before anything is read
+    query = f'SELECT {_item_columns(fields)} FROM items'
+    conditions = []
+    params = []
+    if tags:
+        tags = list(dict.fromkeys(tags))
+        placeholders = ', '.join('?' for _ in tags)
+        conditions.append(f'''id IN (
+            SELECT item_id FROM item_tags WHERE tag IN ({placeholders})
+            GROUP BY item_id HAVING COUNT(*) = ?
+        )''')
+        params.extend(tags)
+        params.append(len(tags))
+    if after_id is not None:
+        conditions.append('id > ?')
+        params.append(after_id)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY id'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    return (conn or get_connection()).execute(query, params)
+
+
+def _build_match_query(query):
+    # Quote every word so FTS5 operators in user input are taken literally, and match it as a prefix
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+# Function to search items by name, link and tags, best matches first
+def search_items(query, limit=SEARCH_LIMIT):
+    limit = max(1, min(int(limit), SEARCH_LIMIT_MAX))
+    conn = get_connection()
+
+    if fts_enabled:
+        match_query = _build_match_query(query)
+        if not match_query:
+            return []
+        items = conn.execute('''
+            SELECT items.* FROM items_fts
+            JOIN items ON items.id = items_fts.rowid
+            WHERE items_fts MATCH ?
+            ORDER BY bm25(items_fts, 10.0, 1.0, 5.0)
+            LIMIT ?
+        ''', [match_query, limit]).fetchall()
+    else:
+        # Plain substring search when the SQLite build has no FTS5
+        pattern = f"%{query.strip()}%"
+        items = conn.execute(
+            'SELECT * FROM items WHERE name LIKE ? OR link LIKE ? OR tags LIKE ? ORDER BY name LIMIT ?',
+            [pattern, pattern, pattern, limit]).fetchall()
     return [dict(item) for item in items]
 
 
+# Columns of the esp table returned with every locate target
+ESP_LAYOUT_COLUMNS = ('id', 'name', 'esp_ip', 'rows', 'cols', 'start_top', 'start_left', 'orientation', 'serpentine')
+
+
+# Function to resolve the items to light up, together with their ESP, in one query.
+# Items are selected by id, by tags (all must match) or by a search query.
+def get_locate_targets(item_ids=None, tags=None, query=None):
+    esp_columns = ', '.join(f'esp.{column} AS esp_{column}' for column in ESP_LAYOUT_COLUMNS)
+    sql = f'''
+        SELECT items.id, items.name, items.position, items.quantity, items.ip, {esp_columns}
+        FROM items
+        LEFT JOIN esp ON esp.id = items.esp_id
+    '''
+    conditions = []
+    params = []
+    if item_ids:
+        conditions.append(f"items.id IN ({', '.join('?' for _ in item_ids)})")
+        params.extend(item_ids)
+    if tags:
+        tags = list(dict.fromkeys(tags))
+        conditions.append(f'''items.id IN (
+            SELECT item_id FROM item_tags WHERE tag IN ({', '.join('?' for _ in tags)})
+            GROUP BY item_id HAVING COUNT(*) = ?
+        )''')
+        params.extend(tags)
+        params.append(len(tags))
+    if query:
+        if fts_enabled:
+            match_query = _build_match_query(query)
+            if not match_query:
+                return []
+            conditions.append('items.id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ? LIMIT ?)')
+            params.extend([match_query, SEARCH_LIMIT_MAX])
+        else:
+            pattern = f"%{query.strip()}%"
+            conditions.append('(items.name LIKE ? OR items.link LIKE ? OR items.tags LIKE ?)')
+            params.extend([pattern, pattern, pattern])
+    if not conditions:
+        return []
+    sql += ' WHERE ' + ' AND '.join(conditions) + ' ORDER BY items.id'
+
+    conn = get_connection()
+    return [_locate_target(row) for row in conn.execute(sql, params).fetchall()]
+
+
+def get_locate_target(item_id):
+    """Return one item with its ESP layout through the indexed esp_id join, or None."""
+    esp_columns = ', '.join(f'esp.{column} AS esp_{column}' for column in ESP_LAYOUT_COLUMNS)
+    row = get_connection().execute(f'''
+        SELECT items.id, items.name, items.position, items.quantity, items.ip, {esp_columns}
+        FROM items
+        LEFT JOIN esp ON esp.id = items.esp_id
+        WHERE items.id = ?
+    ''', [item_id]).fetchone()
+    return _locate_target(row) if row else None
+
+
+def _locate_target(row):
+    # Move the esp_* columns into a nested 'esp' dict, None when the item has no known ESP
+    row = dict(row)
+    esp = {column: row.pop(f'esp_{column}') for column in ESP_LAYOUT_COLUMNS}
+    row['esp'] = esp if esp['id'] is not None else None
+    return row
+
+
 def write_item(item):
-    conn = create_combined_db()
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('INSERT INTO items (name, link, image, position, quantity, ip, tags) VALUES (?, ?, ?, ?, ?, ?, ?)',
+    cursor.execute('INSERT INTO items (name, link, image, position, quantity, ip, tags, updated_seq) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
                    [item['name'], item['link'], item['image'], item['position'], item['quantity'], item['ip'],
-                    item['tags']])
+                    item['tags'], _next_item_seq(conn)])
     lastId = cursor.lastrowid
+    _write_item_tags(conn, lastId, item['tags'])
+    _link_items_to_esp(conn, 'id = ?', [lastId])
+    _index_item_positions(conn, 'id = ?', [lastId])
     conn.commit()
-    conn.close()
     return lastId
 
 
 def update_item_image(item_id, new_image_url):
-    conn = create_combined_db()
+    conn = get_connection()
     try:
         cursor = conn.cursor()
         # Update the image of the item with the specified item_id
-        cursor.execute('UPDATE items SET image = ? WHERE id = ?', [new_image_url['image'], item_id])
+        cursor.execute('UPDATE items SET image = ?, updated_seq = ? WHERE id = ?',
+                       [new_image_url['image'], _next_item_seq(conn), item_id])
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         print(e)
-    finally:
-        conn.close()
 
 
 # Function to update data in the database
 def update_item(id, data):
-    conn = create_combined_db()
+    conn = get_connection()
 
     try:
 
-        conn.execute(
-            'UPDATE items SET name = ?, link = ?, image = ?, position = ?, quantity = ?, ip = ?, tags = ? WHERE id = ?',
+        cursor = conn.execute(
+            'UPDATE items SET name = ?, link = ?, image = ?, position = ?, quantity = ?, ip = ?, tags = ?, '
+            'updated_seq = ? WHERE id = ?',
             [data['name'], data['link'], data['image'], data['position'], data['quantity'], data['ip'], data['tags'],
-             id])
+             _next_item_seq(conn), id])
+        if cursor.rowcount == 0:
+            # No such item, don't leave index rows behind for it
+            conn.rollback()
+            return False
+        _write_item_tags(conn, id, data['tags'])
+        _link_items_to_esp(conn, 'id = ?', [id])
+        _index_item_positions(conn, 'id = ?', [id])
         conn.commit()
+        return True
     except sqlite3.Error as e:
         conn.rollback()
-    finally:
-        conn.close()
+        return False
 
 
 def update_item_quantity(id, data):
-    conn = create_combined_db()
+    conn = get_connection()
     try:
 
         conn.execute(
-            'UPDATE items SET  quantity = ? WHERE id = ?',
-            [data['quantity'], id])
+            'UPDATE items SET  quantity = ?, updated_seq = ? WHERE id = ?',
+            [data['quantity'], _next_item_seq(conn), id])
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         print(e)
-    finally:
+
+
+def iter_items(fields=None, tags=None, batch=500):
+    """Like read_items(), but returns an iterator over the rows that fetches batch rows at a time.
+
+    The query runs right away, so invalid fields raise ValueError before a response is started.
+    The rows are read from a dedicated connection outside the pool, closed once the iterator
+    finishes, so a slow client reading a long response does not hold a pooled connection.
+    """
+    conn = _open_connection()
+    try:
+        cursor = _items_cursor(fields, tags=tags, conn=conn)
+    except Exception:
         conn.close()
+        raise
+    return _iter_cursor(cursor, batch, conn)
+
+
+def _iter_cursor(cursor, batch, conn=None):
+    try:
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        # Also runs when the client disconnects and the response closes the generator
+        if conn is not None:
+            conn.close()
+
+
+def _insert_item_batch(conn, items):
+    # All items of a batch share one change number, which also finds their new ids for the tag index
+    seq = _next_item_seq(conn)
+    conn.executemany('INSERT INTO items (name, link, image, position, quantity, ip, tags, updated_seq) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(item['name'], item['link'], item['image'], item['position'], item['quantity'], item['ip'],
+                       item['tags'], seq) for item in items])
+    rows = conn.execute('SELECT id, tags FROM items WHERE updated_seq = ?', [seq]).fetchall()
+    conn.executemany('INSERT OR IGNORE INTO item_tags (item_id, tag) VALUES (?, ?)',
+                     [(row['id'], tag) for row in rows for tag in parse_tags(row['tags'])])
+    _link_items_to_esp(conn, 'updated_seq = ?', [seq])
+    _index_item_positions(conn, 'updated_seq = ?', [seq])
+    return len(items)
+
+
+def import_items(rows):
+    """Insert the (line, item, error) rows of items_io.parse_rows() in batches inside a single transaction.
+
+    Returns the number of imported items and a {'line', 'error'} entry per rejected row.
+    Nothing is stored when reading the file or writing to the database fails halfway.
+    """
+    conn = get_connection()
+    imported = 0
+    errors = []
+    batch = []
+    try:
+        for line, item, error in rows:
+            if error:
+                errors.append({'line': line, 'error': error})
+                continue
+            batch.append(item)
+            if len(batch) >= IMPORT_BATCH:
+                imported += _insert_item_batch(conn, batch)
+                batch = []
+        if batch:
+            imported += _insert_item_batch(conn, batch)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return imported, errors
+
+
+def adjust_stock(adjustments):
+    """Add the (item id, delta) adjustments to the quantities in one transaction, never going below 0.
+
+    Returns the new {id: quantity} of the adjusted items and the ids that do not exist.
+    """
+    deltas = {}
+    for item_id, delta in adjustments:
+        deltas[item_id] = deltas.get(item_id, 0) + delta
+
+    conn = get_connection()
+    try:
+        seq = _next_item_seq(conn)
+        # The increment happens in SQL, so concurrent adjustments of the same item are never lost
+        conn.executemany('UPDATE items SET quantity = MAX(COALESCE(quantity, 0) + ?, 0), updated_seq = ? WHERE id = ?',
+                         [(delta, seq, item_id) for item_id, delta in deltas.items()])
+        placeholders = ', '.join('?' for _ in deltas)
+        rows = conn.execute(f'SELECT id, quantity FROM items WHERE id IN ({placeholders})', list(deltas)).fetchall()
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    quantities = {row['id']: row['quantity'] for row in rows}
+    return quantities, [item_id for item_id in deltas if item_id not in quantities]
+
+
+def get_occupancy(esp_id):
+    """Return the ids of the items on every taken position of an ESP grid as a {position: [item ids]} map."""
+    rows = get_connection().execute(
+        'SELECT position, item_id FROM item_positions WHERE esp_id = ? ORDER BY position, item_id', [esp_id])
+    occupancy = {}
+    for row in rows:
+        occupancy.setdefault(row['position'], []).append(row['item_id'])
+    return occupancy
+
+
+def get_position_conflicts(item_id):
+    """Other items sharing a position on the same ESP with the given item."""
+    rows = get_connection().execute('''
+        SELECT other.position, other.item_id, items.name
+        FROM item_positions AS mine
+        JOIN item_positions AS other
+            ON other.esp_id = mine.esp_id AND other.position = mine.position AND other.item_id != mine.item_id
+        JOIN items ON items.id = other.item_id
+        WHERE mine.item_id = ?
+        ORDER BY other.position, other.item_id
+    ''', [item_id]).fetchall()
+    return [dict(row) for row in rows]
 
 
 def get_item(id):
-    conn = create_combined_db()
+    conn = get_connection()
     item = conn.execute('SELECT * FROM items WHERE id = ?', [id]).fetchone()
-    conn.close()
     return dict(item) if item else None
 
 
 def delete_item(id):
-    conn = create_combined_db()
-    conn.execute('DELETE FROM items WHERE id = ?', [id])
+    conn = get_connection()
+    conn.execute('DELETE FROM item_tags WHERE item_id = ?', [id])
+    conn.execute('DELETE FROM item_positions WHERE item_id = ?', [id])
+    deleted = conn.execute('DELETE FROM items WHERE id = ?', [id]).rowcount
+    if deleted:
+        # Keep a tombstone so clients doing a delta sync drop the item too
+        conn.execute('INSERT OR REPLACE INTO item_tombstones (id, deleted_seq) VALUES (?, ?)',
+                     [id, _next_item_seq(conn)])
     conn.commit()
-    conn.close()
+
+
+def get_item_changes(since):
+    """Items written and ids of items deleted after the change number since, with the new high-water mark."""
+    conn = get_connection()
+    # One read transaction, so the mark, the items and the tombstones come from the same snapshot
+    # and an item deleted in between is never reported as both changed and deleted
+    conn.execute('BEGIN')
+    try:
+        seq = conn.execute("SELECT version FROM table_versions WHERE name = 'item_seq'").fetchone()[0]
+        items = conn.execute('SELECT * FROM items WHERE updated_seq > ? ORDER BY updated_seq', [since]).fetchall()
+        deleted = conn.execute('SELECT id FROM item_tombstones WHERE deleted_seq > ? ORDER BY deleted_seq',
+                               [since]).fetchall()
+    finally:
+        conn.commit()
+    return {'items': [dict(item) for item in items], 'deleted': [row['id'] for row in deleted], 'seq': seq}
 
 
 # Function to write ESP settings to the database
@@ -163,11 +923,11 @@ def write_esp_settings(esp_settings):
         print("Missing required fields in esp_settings")
         return None
 
-    conn = create_combined_db()
+    conn = get_connection()
     try:
         cursor = conn.cursor()
         cursor.execute(
-            'INSERT INTO esp (name, esp_ip, rows, cols, start_top, start_left,orientation, serpentine ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            'INSERT INTO esp (name, esp_ip, rows, cols, start_top, start_left,orientation, serpentine, transport) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
             [
                 esp_settings['name'],
                 esp_settings['esp_ip'],
@@ -176,26 +936,26 @@ def write_esp_settings(esp_settings):
                 esp_settings['startTop'],
                 esp_settings['startLeft'],
                 esp_settings['orientation'],
-                esp_settings['serpentine']
+                esp_settings['serpentine'],
+                esp_settings.get('transport') or 'http'
             ])
         lastId = cursor.lastrowid
+        _link_items_to_esp(conn, seq=_next_item_seq(conn))
         conn.commit()
     except Exception as e:
         print(f"Database error: {e}")
         conn.rollback()
         lastId = None
-    finally:
-        conn.close()
 
     return lastId
 
 
 # Function to update ESP settings in the database
 def update_esp_settings(id, esp_settings):
-    conn = create_combined_db()
+    conn = get_connection()
     try:
         conn.execute(
-            'UPDATE esp SET name = ?, esp_ip = ?, rows = ?, cols = ?, start_top = ?, start_left = ?,orientation = ?, serpentine = ? WHERE id = ?',
+            'UPDATE esp SET name = ?, esp_ip = ?, rows = ?, cols = ?, start_top = ?, start_left = ?,orientation = ?, serpentine = ?, transport = COALESCE(?, transport) WHERE id = ?',
             [
                 esp_settings['name'],
                 esp_settings['esp_ip'],
@@ -205,21 +965,20 @@ def update_esp_settings(id, esp_settings):
                 esp_settings['startLeft'],
                 esp_settings['orientation'],
                 esp_settings['serpentine'],
+                esp_settings.get('transport'),  # keeps the current transport when not given
                 id
             ])
+        # Items may refer to the ESP by its old or new name or IP
+        _link_items_to_esp(conn, seq=_next_item_seq(conn))
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
 
-    finally:
-        conn.close()
-
 
 # Function to get ESP settings from the database by ID
 def get_esp_settings(id):
-    conn = create_combined_db()
+    conn = get_connection()
     esp_settings = conn.execute('SELECT * FROM esp WHERE id = ?', [id]).fetchone()
-    conn.close()
     if esp_settings:
         return dict(esp_settings)
     else:
@@ -227,26 +986,25 @@ def get_esp_settings(id):
 
 
 def read_esp():
-    conn = create_combined_db()
+    conn = get_connection()
     esps = conn.execute('SELECT * FROM esp').fetchall()
-    conn.close()
     return [dict(esp) for esp in esps]
 
 
 # Function to delete ESP settings from the database by ID
 def delete_esp_settings(id):
-    conn = create_combined_db()
+    conn = get_connection()
     try:
         conn.execute('DELETE FROM esp WHERE id = ?', [id])
+        conn.execute('DELETE FROM item_positions WHERE esp_id = ?', [id])
+        _link_items_to_esp(conn, seq=_next_item_seq(conn))
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
-    finally:
-        conn.close()
 
 
 def get_esp_settings_by_id(id):
-    conn = create_combined_db()  # Get a database connection
+    conn = get_connection()
     try:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM esp WHERE id = ?', (id,))
@@ -264,12 +1022,9 @@ def get_esp_settings_by_id(id):
         print(f"Database error: {e}")
         return None
 
-    finally:
-        conn.close()
-
 
 def get_esp_settings_by_ip(ip):
-    conn = create_combined_db()  # Get a database connection
+    conn = get_connection()
     try:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM esp WHERE esp_ip = ?', (ip,))
@@ -286,20 +1041,16 @@ def get_esp_settings_by_ip(ip):
         print(f"Database error: {e}")
         return None
 
-    finally:
-        conn.close()
-
 
 def get_ip_by_name(esp_name):
-    conn = create_combined_db()
+    conn = get_connection()
     esp = conn.execute('SELECT esp_ip FROM esp WHERE name = ?', (esp_name,)).fetchone()
-    conn.close()
     return esp['esp_ip'] if esp else None
 
 
 # Function to read settings from the database
 def read_settings():
-    conn = create_combined_db()
+    conn = get_connection()
     try:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM settings')
@@ -326,47 +1077,99 @@ def read_settings():
     except sqlite3.Error as e:
         print(f"SQLite error while reading settings: {e}")
         return {}
-    finally:
-        conn.close()
 
 
 # Function to update settings in the database
 def update_settings(settings):
+    global _settings
+    conn = get_connection()
     try:
         # Serialize the colors list to a JSON string
         settings['colors'] = json.dumps(settings['colors'])
-        conn = create_combined_db()
         cursor = conn.cursor()
+        # Bump the version so other processes reload their cached settings
+        version = read_settings_version(conn) + 1
         cursor.execute('DELETE FROM settings')  # Clear existing settings
         cursor.execute('''
-            INSERT INTO settings (brightness, timeout, lightMode, colors, language)
-            VALUES (?, ?, ?, ?, ?)
-        ''', [settings['brightness'], settings['timeout'], settings['lightMode'], settings['colors'], settings['language']])
+            INSERT INTO settings (brightness, timeout, lightMode, colors, language, version)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [settings['brightness'], settings['timeout'], settings['lightMode'], settings['colors'],
+              settings['language'], version])
         conn.commit()
     except sqlite3.Error as e:
+        conn.rollback()
         print(f"SQLite error while updating settings: {e}")
-    finally:
-        conn.close()
+        return
+    # Write through to the cache of this process
+    fresh = _settings_from_dict(read_settings())
+    with _settings_lock:
+        _settings = fresh
+
+
+def read_settings_version(conn=None):
+    conn = conn or get_connection()
+    row = conn.execute('SELECT version FROM settings').fetchone()
+    return (row['version'] or 0) if row else 0
+
+
+def _settings_from_dict(settings):
+    colors = settings.get('colors')
+    if not (isinstance(colors, list) and len(colors) >= 2):
+        colors = ['#00ff00', '#00ff00']
+    return Settings(
+        brightness=settings.get('brightness', 100) / 100,
+        timeout=settings.get('timeout', 5),
+        standby_color=colors[0],
+        locate_color=colors[1],
+        light_mode=settings.get('lightMode', 'light'),
+        language=settings.get('language', 'en'),
+        version=settings.get('version') or 0
+    )
 
 
-def get_all_tags():
-    conn = create_combined_db()
-    cursor = conn.cursor()
+def get_settings():
+    """Return the settings cached in this process.
+
+    They are read once and only read again when the version counter in the database
+    changed, which is checked at most every SETTINGS_CHECK_INTERVAL seconds.
+    """
+    global _settings, _settings_checked_at
+    now = time.monotonic()
+    with _settings_lock:
+        cached = _settings
+        if cached is not None and now - _settings_checked_at < SETTINGS_CHECK_INTERVAL:
+            return cached
+        _settings_checked_at = now
 
     try:
-        # Fetch all distinct tags from the items table
-        cursor.execute('SELECT tags FROM items')
-        raw_tags = [tag['tags'] for tag in cursor.fetchall() if tag['tags']]
-
-        # Parse the JSON strings representing lists
-        tags = [tag for raw_tag in raw_tags for tag in json.loads(raw_tag)]
-        # Count the occurrences of each tag
-        tag_counts = Counter(tags)
-        unique_tags_with_count = [{'tag': tag, 'count': count} for tag, count in tag_counts.items()]
-        unique_tags_with_count.sort(key=lambda x: x['count'], reverse=True)
-        return unique_tags_with_count
-    finally:
-        conn.close()
+        if cached is not None and read_settings_version() == cached.version:
+            return cached
+    except sqlite3.Error as e:
+        print(f"SQLite error while checking the settings version: {e}")
+        if cached is not None:
+            return cached
+
+    fresh = _settings_from_dict(read_settings())
+    with _settings_lock:
+        _settings = fresh
+    return fresh
+
+
+def invalidate_settings():
+    global _settings
+    with _settings_lock:
+        _settings = None
+
+
+def get_all_tags():
+    conn = get_connection()
+    # Count the items per tag straight from the tag index
+    tags = conn.execute('''
+        SELECT tag, COUNT(*) AS count FROM item_tags
+        GROUP BY tag
+        ORDER BY count DESC, tag
+    ''').fetchall()
+    return [{'tag': tag['tag'], 'count': tag['count']} for tag in tags]
 
 
 # Migration only needed if you are coming from an older version.
@@ -392,7 +1195,7 @@ def migrate_items():
     items = conn_data.execute('SELECT * FROM items').fetchall()
 
     # Check if 'tags' column exists in the source database
-    column_names = [description[0] for description in conn_data.execute('PRAGMA table_info(items)').fetchall()]
+    column_names = [column[1] for column in conn_data.execute('PRAGMA table_info(items)').fetchall()]
     has_tags_column = 'tags' in column_names
 
     for item in items:
@@ -473,17 +1276,42 @@ def should_perform_migration(database_path, table_name):
     return False
 
 
+def rebuild_item_indexes():
+    """Rebuild the tags, ESP links, positions and change numbers of all items from their columns."""
+    conn = get_connection()
+    try:
+        seq = _next_item_seq(conn)
+        conn.execute('UPDATE items SET updated_seq = ? WHERE updated_seq = 0', [seq])
+        conn.execute('DELETE FROM item_tags')
+        rows = conn.execute("SELECT id, tags FROM items WHERE tags IS NOT NULL AND tags != ''").fetchall()
+        conn.executemany('INSERT OR IGNORE INTO item_tags (item_id, tag) VALUES (?, ?)',
+                         [(row['id'], tag) for row in rows for tag in parse_tags(row['tags'])])
+        _link_items_to_esp(conn)
+        conn.execute('DELETE FROM item_positions')
+        _index_item_positions(conn)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
 def perform_migration():
     """Perform migration."""
-    create_combined_db()
+    init_db()
     # Check and migrate items
+    migrated = False
     if should_perform_migration(DATABASE, 'items'):
         migrate_items()
+        migrated = True
         print("Items migration successful.")
     # Check and migrate ESP settings
     if should_perform_migration(DATABASE_ESP, 'esp'):
         migrate_esp_settings()
+        migrated = True
         print("ESP settings migration successful.")
+    # Migrated rows bypass the write functions, so their indexes are built afterwards
+    if migrated:
+        rebuild_item_indexes()
     # Check and migrate general settings
     if should_perform_migration(DATABASE_SETTING, 'settings'):
         migrate_settings()
@@ -0,0 +1,158 @@
+# Streaming import and export of items as CSV and JSON Lines
+import csv
+import io
+import json
+import shutil
+import tempfile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Formats understood by the import route, exports can also be a single JSON array
+FORMATS = ('csv', 'jsonl')
+EXPORT_FORMATS = FORMATS + ('json',)
+
+# Item columns read from and written to the files, the id is assigned by the database
+IMPORT_FIELDS = ('name', 'link', 'image', 'position', 'quantity', 'ip', 'tags')
+EXPORT_FIELDS = ('id',) + IMPORT_FIELDS
+
+# Rows collected before they are written to the output
+EXPORT_CHUNK = 500
+
+# Uploads up to this size are spooled in memory, larger ones go to a temporary file
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+def dumps(value):
+    """Serialize to compact JSON text, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value, separators=(',', ':'))
+
+
+def detect_format(requested, filename=None, content_type=None, formats=FORMATS):
+    """Pick the file format from the ?format= argument, the file extension or the content type."""
+    if requested:
+        requested = requested.lower()
+        return requested if requested in formats else None
+    if filename and '.' in filename:
+        extension = filename.rsplit('.', 1)[1].lower()
+        if extension in ('jsonl', 'ndjson'):
+            return 'jsonl'
+        if extension == 'csv':
+            return 'csv'
+    if content_type and 'csv' in content_type:
+        return 'csv'
+    return 'jsonl'
+
+
+def _parse_list(value, convert):
+    # JSON arrays or comma separated values, as spreadsheets rarely contain JSON
+    if value in (None, ''):
+        return []
+    if isinstance(value, str):
+        value = value.strip()
+        value = json.loads(value) if value.startswith('[') else [part.strip() for part in value.split(',')]
+    if not isinstance(value, list):
+        raise ValueError('expected a list')
+    return [convert(part) for part in value if part not in (None, '')]
+
+
+def normalize_item(row):
+    """Turn one parsed row into the values stored by write_item, raises ValueError for invalid rows."""
+    name = str(row.get('name') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    try:
+        positions = _parse_list(row.get('position'), int)
+    except (TypeError, ValueError):
+        raise ValueError('position must be a list of numbers')
+    try:
+        quantity = int(row['quantity']) if row.get('quantity') not in (None, '') else 0
+    except (TypeError, ValueError):
+        raise ValueError('quantity must be a number')
+    try:
+        tags = _parse_list(row.get('tags'), str)
+    except (TypeError, ValueError):
+        raise ValueError('tags must be a list')
+
+    # Stored the same way as the web UI's JSON.stringify() does
+    return {
+        'name': name,
+        'link': row.get('link') or '',
+        'image': row.get('image') or '',
+        'position': json.dumps(positions, separators=(',', ':')),
+        'quantity': quantity,
+        'ip': row.get('ip') or '',
+        'tags': json.dumps(list(dict.fromkeys(tags)), separators=(',', ':'))
+    }
+
+
+def spool(stream):
+    """Read the whole upload stream into a temporary file and return it rewound to the start."""
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    shutil.copyfileobj(stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def parse_rows(stream, file_format):
+    """Yield (line number, item or None, error or None) for every row of a binary upload stream."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            try:
+                yield reader.line_num, normalize_item(row), None
+            except ValueError as e:
+                yield reader.line_num, None, str(e)
+        return
+
+    for line_number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError('expected a JSON object')
+            yield line_number, normalize_item(row), None
+        except ValueError as e:
+            yield line_number, None, str(e)
+
+
+def export_csv(rows):
+    """Yield the items as CSV text, a chunk of rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([row[field] for field in EXPORT_FIELDS])
+        if count % EXPORT_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_jsonl(rows):
+    """Yield the items as JSON Lines, one object per line."""
+    for row in rows:
+        yield dumps({field: row[field] for field in EXPORT_FIELDS}) + '\n'
+
+
+def json_array(rows):
+    """Yield the rows as one JSON array, a chunk of elements at a time, so memory stays flat."""
+    chunk = []
+    separator = '['
+    for row in rows:
+        chunk.append(dumps(dict(row)))
+        if len(chunk) == EXPORT_CHUNK:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+    if chunk:
+        yield separator + ','.join(chunk) + ']'
+    else:
+        yield '[]' if separator == '[' else ']'
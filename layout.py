@@ -0,0 +1,122 @@
+# Compiled position -> LED lookup tables for the ESP grids
+import threading
+from array import array
+from operator import itemgetter
+
+# Columns of the esp table that decide how positions map to LEDs
+LAYOUT_FIELDS = ('rows', 'cols', 'start_top', 'start_left', 'orientation', 'serpentine')
+
+# Compiled tables per ESP id, together with the layout they were built from
+_tables = {}
+_lock = threading.Lock()
+
+
+def compile_layout(esp):
+    """Build the LED number of every position (1-based) of an ESP grid as a compact array."""
+    rows = esp['rows']
+    columns = esp['cols']
+    start_y = esp['start_top'].lower()
+    start_x = esp['start_left'].lower()
+    orientation = esp['orientation'].lower()
+    serpentine = esp['serpentine'].lower()
+
+    # Ensure '1' values are interpreted as specific directions
+    if start_x == "1":
+        start_x = "right"
+    if start_y == "1":
+        start_y = "bottom"
+    if orientation == "1":
+        orientation = "vertical"
+
+    table = array('I')
+    for i in range(rows * columns):
+        if orientation == "horizontal":
+            # Calculate row and column based on the index for horizontal orientation
+            row = i // columns
+            if serpentine == "1" and row % 2 == 1:
+                # Reverse the column for every other row (serpentine effect)
+                column = columns - 1 - (i % columns)
+            else:
+                column = i % columns
+        else:  # Vertical orientation
+            column = i // rows
+            if serpentine == "1" and column % 2 == 1:
+                # Reverse the row for every other column (serpentine effect)
+                row = rows - 1 - (i % rows)
+            else:
+                row = i % rows
+
+        # Adjust for starting positions
+        if start_x == "right":
+            column = columns - 1 - column
+        if start_y == "bottom":
+            row = rows - 1 - row
+
+        # Calculate the LED number
+        table.append(row * columns + column)
+
+    # Store small grids in 16 bit entries
+    return array('H', table) if not table or max(table) <= 0xFFFF else table
+
+
+def get_table(esp):
+    """Return the compiled table of an ESP, rebuilding it when its layout columns changed."""
+    key = str(esp.get('id', esp.get('esp_ip')))
+    signature = tuple(esp[field] for field in LAYOUT_FIELDS)
+    with _lock:
+        cached = _tables.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    table = compile_layout(esp)
+    with _lock:
+        _tables[key] = (signature, table)
+    return table
+
+
+def invalidate(esp_id=None):
+    """Forget the compiled table of one ESP, or of all ESPs."""
+    with _lock:
+        if esp_id is None:
+            _tables.clear()
+        else:
+            _tables.pop(str(esp_id), None)
+
+
+def translate(positions, esp):
+    """Translate 1-based grid positions to LED numbers with a single table gather."""
+    table = get_table(esp)
+    indices = [int(pos) - 1 for pos in positions]
+    if indices and (min(indices) < 0 or max(indices) >= len(table)):
+        print(f"Ignoring positions outside of the {esp['rows']}x{esp['cols']} grid")
+        indices = [i for i in indices if 0 <= i < len(table)]
+    if not indices:
+        return []
+    leds = itemgetter(*indices)(table)
+    return list(leds) if len(indices) > 1 else [leds]
+
+
+def occupancy_bitmap(esp, occupied):
+    """Render the taken positions of an ESP grid as one string of '0' (free) and '1' (taken) per row."""
+    rows, columns = int(esp['rows']), int(esp['cols'])
+    cells = ['1' if position in occupied else '0' for position in range(1, rows * columns + 1)]
+    return [''.join(cells[row * columns:(row + 1) * columns]) for row in range(rows)]
+
+
+def find_free(esp, occupied, count=1, together=False):
+    """Return count free positions of an ESP grid, or [] when there are not enough.
+
+    With together the positions are neighbours within one row of the grid.
+    """
+    rows, columns = int(esp['rows']), int(esp['cols'])
+    if not together:
+        free = [position for position in range(1, rows * columns + 1) if position not in occupied]
+        return free[:count] if len(free) >= count else []
+
+    for row in range(rows):
+        run = []
+        for position in range(row * columns + 1, (row + 1) * columns + 1):
+            run = run + [position] if position not in occupied else []
+            if len(run) == count:
+                return run
+    return []
@@ -0,0 +1,76 @@
+# UDP realtime protocols understood by WLED: DDP and WLED's own DRGB / DNRGB format
+import os
+import socket
+import struct
+import threading
+
+# UDP ports the ESPs listen on for realtime data
+DDP_PORT = int(os.getenv('WLED_DDP_PORT', 4048))
+WLED_UDP_PORT = int(os.getenv('WLED_UDP_PORT', 21324))
+
+# Seconds the ESP keeps showing a DRGB/DNRGB frame before returning to its normal state, 255 keeps it forever
+REALTIME_TIMEOUT = int(os.getenv('WLED_REALTIME_TIMEOUT', 255))
+
+# Payload limits per packet
+DDP_MAX_DATA = 1440  # 480 RGB LEDs
+DRGB_MAX_LEDS = 490
+DNRGB_MAX_LEDS = 489
+
+# WLED UDP realtime protocol ids
+PROTOCOL_DRGB = 2
+PROTOCOL_DNRGB = 4
+
+# DDP header values: version 1 with the push flag on the last packet, 8 bit RGB data, default output id
+DDP_VERSION = 0x40
+DDP_PUSH = 0x01
+DDP_TYPE_RGB8 = 0x0B
+DDP_ID_DISPLAY = 0x01
+
+_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+_sequence = 0
+_sequence_lock = threading.Lock()
+
+
+def _next_sequence():
+    # DDP sequence numbers run from 1 to 15, 0 means unused
+    global _sequence
+    with _sequence_lock:
+        _sequence = _sequence % 15 + 1
+        return _sequence
+
+
+def ddp_packets(frame):
+    """Split an RGB frame into DDP packets, the last one tells the ESP to show the frame."""
+    sequence = _next_sequence()
+    packets = []
+    for offset in range(0, max(len(frame), 1), DDP_MAX_DATA):
+        chunk = frame[offset:offset + DDP_MAX_DATA]
+        flags = DDP_VERSION | (DDP_PUSH if offset + DDP_MAX_DATA >= len(frame) else 0)
+        header = struct.pack('!BBBBIH', flags, sequence, DDP_TYPE_RGB8, DDP_ID_DISPLAY, offset, len(chunk))
+        packets.append(header + bytes(chunk))
+    return packets
+
+
+def drgb_packets(frame, timeout=None):
+    """Encode an RGB frame as one DRGB packet, or as DNRGB packets with a start index for long strips."""
+    timeout = REALTIME_TIMEOUT if timeout is None else timeout
+    leds = len(frame) // 3
+    if leds <= DRGB_MAX_LEDS:
+        return [bytes([PROTOCOL_DRGB, timeout]) + bytes(frame)]
+
+    packets = []
+    for start in range(0, leds, DNRGB_MAX_LEDS):
+        chunk = frame[start * 3:(start + DNRGB_MAX_LEDS) * 3]
+        packets.append(bytes([PROTOCOL_DNRGB, timeout, start >> 8, start & 0xFF]) + bytes(chunk))
+    return packets
+
+
+def send_frame(host, frame, protocol):
+    """Send an RGB frame to an ESP with 'ddp' or 'drgb', returns the number of packets."""
+    if protocol == 'ddp':
+        packets, port = ddp_packets(frame), DDP_PORT
+    else:
+        packets, port = drgb_packets(frame), WLED_UDP_PORT
+    for packet in packets:
+        _socket.sendto(packet, (host, port))
+    return len(packets)
@@ -69,6 +69,7 @@ async function addItem(event) {
         })
             .then((response) => response.json())
             .then((data) => {
+                warnPositionConflicts(data.conflicts);
                 // Update the displayed item in the UI
                 item.id = data.id;
                 const col = document.getElementById('items-container-grid').querySelector(`div[data-id="${editingItemId}"]`);
@@ -87,6 +88,7 @@ async function addItem(event) {
         })
             .then((response) => response.json())
             .then((data) => {
+                warnPositionConflicts(data.conflicts);
                 // Create and append the new item to the UI
                 const col = createItem(data);
                 document.getElementById('items-container-grid').appendChild(col);
@@ -105,6 +107,16 @@ async function addItem(event) {
 
 
 
+function warnPositionConflicts(conflicts) {
+    // The item is saved anyway, positions shared with other items are only pointed out
+    if (!conflicts || conflicts.length === 0) {
+        return;
+    }
+    const lines = conflicts.map(conflict => `#${conflict.position}: ${conflict.name}`);
+    alert(`These positions are also used by other items:\n${lines.join('\n')}`);
+}
+
+
 function removeLocalStorage(){
     localStorage.removeItem('led_positions');
     localStorage.removeItem('edit_led_positions');
@@ -421,44 +433,74 @@ function createItem(item) {
 }
 
 
+// Stock changes waiting to be sent, rapid clicks are collected into one request
+const pendingStockDeltas = {};
+let stockFlushTimer = null;
+
 function handleQuantityChange(item, changeValue) {
     const itemId = item.id;
     const quantityElement = document.getElementById(`quantity-${itemId}`);
     if (quantityElement) {
-        let currentQuantity = parseInt(quantityElement.textContent, 10);
-        if (!isNaN(currentQuantity)) {
-            currentQuantity += changeValue; // Increment or decrement quantity
+        const previousQuantity = parseInt(quantityElement.textContent, 10);
+        if (!isNaN(previousQuantity)) {
+            let currentQuantity = previousQuantity + changeValue; // Increment or decrement quantity
             if (currentQuantity < 0) {
                 currentQuantity = 0; // Ensure quantity doesn't go below 0
             }
             quantityElement.textContent = currentQuantity.toString(); // Update the displayed quantity
 
-            // Create the updated item object
-            const updatedItem = { quantity: currentQuantity };
-
-            // Make a fetch request to update the quantity in the database
-            fetch(`/api/items/${itemId}`, {
-                method: 'PUT',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'Update-Quantity': 'true'  // Custom header to indicate quantity update
-                },
-                body: JSON.stringify(updatedItem),
-            })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.error) {
-                        console.error('Error updating quantity:', data.error);
-                    }
-                })
-                .catch(error => {
-                    console.error('Error updating quantity:', error);
-                });
+            // The server adds the delta itself, so concurrent changes by other users are not overwritten.
+            // Only the change actually shown is sent, so clicks below 0 don't drain the stock further.
+            pendingStockDeltas[itemId] = (pendingStockDeltas[itemId] || 0) + (currentQuantity - previousQuantity);
+            clearTimeout(stockFlushTimer);
+            stockFlushTimer = setTimeout(flushStockChanges, 300);
         }
     }
 }
 
 
+function flushStockChanges() {
+    const adjustments = Object.entries(pendingStockDeltas)
+        .filter(([, delta]) => delta !== 0)
+        .map(([id, delta]) => ({ id: parseInt(id, 10), delta: delta }));
+    Object.keys(pendingStockDeltas).forEach(id => delete pendingStockDeltas[id]);
+    if (adjustments.length === 0) {
+        return;
+    }
+
+    fetch('/api/items/stock', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ adjustments: adjustments }),
+    })
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                console.error('Error updating quantity:', data.error);
+                return;
+            }
+            // Show the quantities as stored, including changes made by others in the meantime
+            data.items.forEach(updated => {
+                const quantityElement = document.getElementById(`quantity-${updated.id}`);
+                if (quantityElement) {
+                    // Clicks made while the request was on its way are still pending
+                    const pending = pendingStockDeltas[updated.id] || 0;
+                    quantityElement.textContent = Math.max(updated.quantity + pending, 0).toString();
+                }
+                const fetchedItem = fetchedItems.find(item => item.id === updated.id);
+                if (fetchedItem) {
+                    fetchedItem.quantity = updated.quantity;
+                }
+            });
+        })
+        .catch(error => {
+            console.error('Error updating quantity:', error);
+        });
+}
+
+
 function generateItemsGrid() {
     const itemsContainer = document.getElementById('items-container-grid');
     // Clear previous content in the container if needed
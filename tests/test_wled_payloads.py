@@ -0,0 +1,100 @@
+# The compact range payloads must light exactly the same LEDs as the old per-index payloads
+import random
+
+import pytest
+
+import wled
+
+TOTAL_LEDS = 120
+COLORS = ['FF0000', '00FF00', '0000FF', 'FFFF00']
+
+
+def render(payload, frame=None, total_leds=TOTAL_LEDS):
+    # LED colours after the ESP applied the payload, starting from frame (all off by default)
+    frame = bytearray(frame if frame is not None else bytes(total_leds * 3))
+    assert wled.render_frame(frame, payload)
+    return bytes(frame)
+
+
+def per_index_payload(led_colors):
+    # The payload set_leds() built before the range form: [index, colour] for every LED
+    leds = []
+    for led, color in led_colors.items():
+        leds.extend([led, color])
+    return {"on": True, "seg": {"i": leds}}
+
+
+def random_frame(rng):
+    return bytes(rng.randrange(256) for _ in range(TOTAL_LEDS * 3))
+
+
+def random_leds(rng):
+    # Mix of isolated LEDs and runs of neighbours, so both encodings get used
+    leds = set()
+    for _ in range(rng.randrange(1, 8)):
+        start = rng.randrange(TOTAL_LEDS)
+        leds.update(range(start, min(start + rng.randrange(1, 12), TOTAL_LEDS)))
+    return sorted(leds)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_led_payload_matches_per_index(seed):
+    rng = random.Random(seed)
+    leds = random_leds(rng)
+    color = '#' + rng.choice(COLORS)
+    before = random_frame(rng)
+
+    old = per_index_payload({led: color[1:] for led in leds})
+    assert render(wled.led_payload(leds, color), before) == render(old, before)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_compact_leds_with_mixed_colors(seed):
+    rng = random.Random(seed)
+    led_colors = {led: rng.choice(COLORS[:2]) for led in random_leds(rng)}
+    before = random_frame(rng)
+
+    compact = {"on": True, "seg": {"i": wled.compact_leds(led_colors)}}
+    assert render(compact, before) == render(per_index_payload(led_colors), before)
+
+
+def test_fill_payload_matches_per_index():
+    before = random_frame(random.Random(1))
+    old = per_index_payload({led: '00FF00' for led in range(TOTAL_LEDS)})
+    assert render(wled.fill_payload(TOTAL_LEDS, '#00FF00'), before) == render(old, before)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_frame_payload_matches_off_then_on(seed):
+    # One frame replaces the old clear to the standby colour followed by the highlight update
+    rng = random.Random(seed)
+    leds = random_leds(rng)
+    before = random_frame(rng)
+
+    old_off = per_index_payload({led: '00FF00' for led in range(TOTAL_LEDS)})
+    old_on = per_index_payload({led: 'FF0000' for led in leds})
+    expected = render(old_on, render(old_off, before))
+
+    frame = wled.frame_payload(TOTAL_LEDS, '#00FF00', {led: '#FF0000' for led in leds}, bri=128)
+    assert render(frame, before) == expected
+
+
+def test_toggle_and_timeout_off_path():
+    # Locating the same positions again and the auto-off both send the standby fill,
+    # which must clear the highlights and stay the same size however often it is sent
+    leds = [3, 4, 5, 40]
+    lit = render(wled.frame_payload(TOTAL_LEDS, '#00FF00', {led: '#FF0000' for led in leds}))
+    off_payload = wled.fill_payload(TOTAL_LEDS, '#00FF00')
+    expected = render(per_index_payload({led: '00FF00' for led in range(TOTAL_LEDS)}))
+
+    first = render(off_payload, lit)
+    second = render(off_payload, first)
+    assert first == expected
+    assert second == expected
+    assert off_payload == {"on": True, "seg": {"i": [0, TOTAL_LEDS, '00FF00']}}
+
+
+def test_ranges_are_clipped_to_the_strip():
+    payload = wled.led_payload(range(TOTAL_LEDS - 2, TOTAL_LEDS + 5), '#FF0000')
+    old = per_index_payload({led: 'FF0000' for led in range(TOTAL_LEDS - 2, TOTAL_LEDS)})
+    assert render(payload) == render(old)
@@ -0,0 +1,694 @@
+# Helpers to talk to several WLED controllers (ESPs) at the same time, one command queue per ESP
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import realtime
+
+# Number of ESPs that are talked to in parallel
+MAX_WORKERS = int(os.getenv('WLED_MAX_WORKERS', 16))
+
+# Extra seconds granted on top of a device's own request timeouts before it is reported as timed out
+DISPATCH_GRACE = 0.1
+
+# Seconds to wait for /json/info before falling back to the default LED count
+INFO_TIMEOUT = float(os.getenv('WLED_INFO_TIMEOUT', 1))
+
+# Seconds an LED command may take per ESP: a possible /json/info read plus the command itself
+COMMAND_TIMEOUT = INFO_TIMEOUT + 0.2
+
+# Seconds a cached /json/info answer is used before it is refreshed in the background
+INFO_TTL = float(os.getenv('WLED_INFO_TTL', 600))
+
+# Seconds before retrying an ESP whose /json/info could not be fetched
+INFO_RETRY = float(os.getenv('WLED_INFO_RETRY', 15))
+
+# Keep-alive connections kept open per ESP
+SESSION_POOL_SIZE = int(os.getenv('WLED_SESSION_POOL_SIZE', 2))
+
+# Retries for requests that could not connect or got a 502/503/504, with a short exponential backoff
+SESSION_RETRIES = int(os.getenv('WLED_SESSION_RETRIES', 1))
+SESSION_BACKOFF = float(os.getenv('WLED_SESSION_BACKOFF', 0.05))
+
+# Seconds between health probes of ESPs that have not been talked to recently
+HEALTH_INTERVAL = float(os.getenv('WLED_HEALTH_INTERVAL', 30))
+
+# Failed requests in a row after which an ESP counts as offline and is skipped
+HEALTH_FAILURES = int(os.getenv('WLED_HEALTH_FAILURES', 3))
+
+# First and longest wait before an offline ESP is tried again, doubling in between
+HEALTH_RETRY = float(os.getenv('WLED_HEALTH_RETRY', 5))
+HEALTH_BACKOFF_MAX = float(os.getenv('WLED_HEALTH_BACKOFF_MAX', 300))
+
+# Ways to send LED frames to an ESP: the JSON API over HTTP or a UDP realtime protocol
+TRANSPORTS = ('http', 'ddp', 'drgb')
+
+# LED count assumed while an ESP cannot be reached
+DEFAULT_LED_COUNT = 1000
+
+# Optionally keep the frames of frequently located items as presets on the ESP and recall them with {"ps": n}
+PRESET_CACHE = os.getenv('WLED_PRESET_CACHE', 'false').lower() in ('1', 'true', 'yes')
+
+# Preset ids reserved for the cache, the range should not overlap with presets made by hand
+PRESET_FIRST = int(os.getenv('WLED_PRESET_FIRST', 200))
+PRESET_SLOTS = int(os.getenv('WLED_PRESET_SLOTS', 50))
+
+# Locates of the same frame before it is saved, saving writes to the ESP's flash
+PRESET_MIN_HITS = int(os.getenv('WLED_PRESET_MIN_HITS', 2))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='wled')
+
+# Transport per ESP, ESPs that are not listed use 'http'
+_transports = {}
+
+# Pooled HTTP session per ESP
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Cached device info per ESP and the ESPs currently being refreshed
+_info_cache = {}
+_info_refreshing = set()
+_info_lock = threading.Lock()
+
+# Pending delayed command per ESP, e.g. the auto-off after a locate
+_timers = {}
+_timers_lock = threading.Lock()
+
+# Health and circuit breaker state per ESP, and the ESPs probed by the health monitor
+_health = {}
+_health_lock = threading.Lock()
+_monitored = set()
+_health_wakeup = threading.Event()
+_health_thread = None
+
+# Cached presets per ESP: frames in least recently used order and locate counts of frames not saved yet
+_presets = {}
+_presets_lock = threading.Lock()
+
+# Command queue, worker thread and LED state per ESP
+_devices = {}
+_devices_lock = threading.Lock()
+_stopping = False
+
+
+def _new_state():
+    # LED state of one ESP, only touched by that ESP's worker thread
+    return {'previous_positions': [], 'cleared': False, 'frame': None}
+
+
+def _device(ip):
+    with _devices_lock:
+        device = _devices.get(ip)
+        if device is None:
+            device = {
+                'pending': deque(),
+                'condition': threading.Condition(),
+                'state': _new_state(),
+                'busy': False,
+                'retired': False,
+                'sent': 0,
+                'dropped': 0
+            }
+            worker = threading.Thread(target=_device_worker, args=(ip, device), name=f'wled-{ip}', daemon=True)
+            _devices[ip] = device
+            worker.start()
+    return device
+
+
+def _device_worker(ip, device):
+    while True:
+        with device['condition']:
+            while not device['pending'] and not _stopping and not device['retired']:
+                device['condition'].wait()
+            # A retired worker still sends what was queued before forget_device()
+            if _stopping or not device['pending']:
+                return
+            command, future = device['pending'].popleft()
+            device['busy'] = True
+
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(command())
+            except Exception as e:
+                print(f"Error talking to {ip}: {e}")
+                future.set_result({'status': 'error', 'error': str(e)})
+
+        with device['condition']:
+            device['busy'] = False
+            device['sent'] += 1
+
+
+def submit(ip, command, coalesce=True):
+    """Queue command() on the ESP's worker and return a Future with its result.
+
+    With coalesce the commands still waiting for this ESP are superseded and dropped,
+    so only the latest target state is sent. Dropped commands resolve to {'status': 'dropped'}.
+    """
+    device = _device(ip)
+    future = Future()
+    with device['condition']:
+        if coalesce:
+            while device['pending']:
+                _, dropped = device['pending'].popleft()
+                device['dropped'] += 1
+                if dropped.set_running_or_notify_cancel():
+                    dropped.set_result({'status': 'dropped'})
+        device['pending'].append((command, future))
+        device['condition'].notify()
+    return future
+
+
+def forget_device(ip):
+    """Retire the worker and state of an ESP that was deleted or moved to another address.
+
+    Commands already queued are still sent, then the worker thread exits.
+    """
+    cancel_scheduled(ip)
+    with _devices_lock:
+        device = _devices.pop(ip, None)
+    if device is None:
+        return
+    with device['condition']:
+        device['retired'] = True
+        device['condition'].notify()
+
+
+def device_state(ip):
+    """LED state of an ESP, to be used from commands running on its worker."""
+    return _device(ip)['state']
+
+
+def reset_device_state(ip):
+    _device(ip)['state'] = _new_state()
+
+
+def queue_stats():
+    """Queue depth, busy flag and sent/dropped counters per ESP for monitoring."""
+    with _devices_lock:
+        devices = dict(_devices)
+    stats = {}
+    for ip, device in devices.items():
+        with device['condition']:
+            stats[ip] = {
+                'depth': len(device['pending']),
+                'busy': device['busy'],
+                'sent': device['sent'],
+                'dropped': device['dropped']
+            }
+    return stats
+
+
+def wait_all(futures, timeout=None):
+    """Wait for a {ip: future} map and return a {ip: result} map.
+
+    Devices that do not finish within timeout seconds are reported as timed out,
+    so the caller never waits longer than the timeout for a slow or offline ESP.
+    """
+    done, _ = wait(futures.values(), timeout=None if timeout is None else timeout + DISPATCH_GRACE)
+
+    results = {}
+    for ip, future in futures.items():
+        if future not in done:
+            results[ip] = {'status': 'timeout', 'latency_ms': round(timeout * 1000)}
+            continue
+        results[ip] = future.result()
+    return results
+
+
+def dispatch(ips, task, timeout=None):
+    """Queue task(ip) for every ESP, run them concurrently and return a {ip: result} map."""
+    futures = {ip: submit(ip, partial(task, ip)) for ip in dict.fromkeys(ips)}
+    return wait_all(futures, timeout)
+
+
+def get_session(ip):
+    """Return the keep-alive HTTP session of an ESP, so commands reuse its TCP connection."""
+    with _sessions_lock:
+        session = _sessions.get(ip)
+        if session is None:
+            # Only retry when the request never reached the ESP or it answered busy, reads are not repeated
+            retry = Retry(total=SESSION_RETRIES, connect=SESSION_RETRIES, read=0, status=SESSION_RETRIES,
+                          backoff_factor=SESSION_BACKOFF, status_forcelist=(502, 503, 504),
+                          allowed_methods=None, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SESSION_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            _sessions[ip] = session
+    return session
+
+
+def close_session(ip):
+    with _sessions_lock:
+        session = _sessions.pop(ip, None)
+    if session is not None:
+        session.close()
+
+
+def session_stats():
+    """Requests sent and TCP connections opened per ESP, the difference are reused connections."""
+    with _sessions_lock:
+        sessions = dict(_sessions)
+    stats = {}
+    for ip, session in sessions.items():
+        pools = session.get_adapter(f"http://{ip}/").poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        sent = sum(pool.num_requests for pool in pools)
+        opened = sum(pool.num_connections for pool in pools)
+        stats[ip] = {'requests': sent, 'connections': opened, 'reused': max(sent - opened, 0)}
+    return stats
+
+
+def fetch_info(ip, timeout=INFO_TIMEOUT):
+    """Read LED count, firmware version and segment capabilities from the ESP's /json/info.
+
+    When the ESP cannot be read the last known values are kept, only an ESP that was never
+    reached falls back to DEFAULT_LED_COUNT.
+    """
+    with _info_lock:
+        previous = _info_cache.get(ip)
+    entry = {
+        'leds': DEFAULT_LED_COUNT,
+        'version': None,
+        'max_segments': None,
+        'segment_capabilities': None,
+        'rgbw': None
+    }
+    if previous is not None:
+        entry.update({key: previous[key] for key in entry})
+    entry.update(fetched_at=time.time(), error=None)
+    response = None
+    start = time.monotonic()
+    try:
+        response = get_session(ip).get(f"http://{ip}/json/info", timeout=timeout)
+        # Any answer means the ESP is reachable
+        record_result(ip, True, round((time.monotonic() - start) * 1000, 1))
+        response.raise_for_status()
+        info = response.json()
+        leds = info.get('leds', {})
+        entry.update({
+            'leds': leds['count'],
+            'version': info.get('ver'),
+            'max_segments': leds.get('maxseg'),
+            'segment_capabilities': leds.get('seglc'),
+            'rgbw': leds.get('rgbw')
+        })
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Error fetching device info of {ip}: {e}")
+        entry['error'] = str(e)
+        if response is None:
+            record_result(ip, False, error=str(e))
+
+    with _info_lock:
+        _info_cache[ip] = entry
+        _info_refreshing.discard(ip)
+    return entry
+
+
+def _is_fresh(entry):
+    ttl = INFO_RETRY if entry['error'] else INFO_TTL
+    return time.time() - entry['fetched_at'] < ttl
+
+
+def refresh_info(ips):
+    """Refresh the device info of the given ESPs in the background."""
+    for ip in ips:
+        with _info_lock:
+            if ip in _info_refreshing:
+                continue
+            _info_refreshing.add(ip)
+        _executor.submit(fetch_info, ip)
+
+
+def get_info(ip):
+    """Return the cached device info of an ESP.
+
+    Only the very first lookup of an ESP waits for /json/info, stale entries are
+    returned as they are and refreshed in the background.
+    """
+    with _info_lock:
+        entry = _info_cache.get(ip)
+    if entry is None:
+        return fetch_info(ip)
+    if not _is_fresh(entry):
+        refresh_info([ip])
+    return entry
+
+
+def invalidate_info(ip):
+    with _info_lock:
+        _info_cache.pop(ip, None)
+
+
+def info_cache_state():
+    """Snapshot of the device info cache for monitoring."""
+    with _info_lock:
+        return {ip: dict(entry, fresh=_is_fresh(entry), refreshing=ip in _info_refreshing)
+                for ip, entry in _info_cache.items()}
+
+
+def _new_health():
+    return {
+        'status': 'unknown',
+        'latency_ms': None,
+        'failures': 0,
+        'last_seen': None,
+        'last_error': None,
+        'next_probe': 0
+    }
+
+
+def record_result(ip, ok, latency_ms=None, error=None):
+    """Update the health of an ESP after a request, opening its circuit after HEALTH_FAILURES failures."""
+    now = time.time()
+    with _health_lock:
+        health = _health.setdefault(ip, _new_health())
+        if ok:
+            health.update(status='online', latency_ms=latency_ms, failures=0, last_seen=now,
+                          next_probe=now + HEALTH_INTERVAL)
+            return
+        health['failures'] += 1
+        health['last_error'] = error
+        if health['failures'] >= HEALTH_FAILURES:
+            backoff = min(HEALTH_RETRY * 2 ** (health['failures'] - HEALTH_FAILURES), HEALTH_BACKOFF_MAX)
+            health.update(status='offline', next_probe=now + backoff)
+        else:
+            health['next_probe'] = now
+
+
+def _available(health, now):
+    return health is None or health['status'] != 'offline' or now >= health['next_probe']
+
+
+def is_available(ip):
+    """False while the circuit of an offline ESP is open, requests to it should be skipped."""
+    with _health_lock:
+        return _available(_health.get(ip), time.time())
+
+
+def health_state():
+    """Status, latency, failures in a row and last-seen time of every known ESP."""
+    now = time.time()
+    with _health_lock:
+        return {ip: dict(_health.get(ip) or _new_health(), available=_available(_health.get(ip), now))
+                for ip in set(_health) | _monitored}
+
+
+def set_monitored(ips):
+    """Replace the set of ESPs probed by the health monitor."""
+    global _monitored
+    with _health_lock:
+        _monitored = set(ips)
+        for ip in list(_health):
+            if ip not in _monitored:
+                del _health[ip]
+    _health_wakeup.set()
+
+
+def _health_loop():
+    while not _stopping:
+        now = time.time()
+        with _health_lock:
+            due = [ip for ip in _monitored if (_health.get(ip) or _new_health())['next_probe'] <= now]
+            upcoming = [(_health.get(ip) or _new_health())['next_probe'] for ip in _monitored]
+        # Probing reads /json/info, which also keeps the device info cache fresh
+        for ip in due:
+            with _info_lock:
+                if ip in _info_refreshing:
+                    continue
+                _info_refreshing.add(ip)
+            with _health_lock:
+                _health.setdefault(ip, _new_health())['next_probe'] = now + HEALTH_INTERVAL
+            _executor.submit(fetch_info, ip)
+
+        wait = min([HEALTH_INTERVAL] + [max(t - now, 0) for t in upcoming if t > now])
+        _health_wakeup.wait(max(wait, 0.5))
+        _health_wakeup.clear()
+
+
+def start_health_monitor():
+    """Start probing the monitored ESPs in the background."""
+    global _health_thread
+    if _health_thread is not None and _health_thread.is_alive():
+        return
+    _health_thread = threading.Thread(target=_health_loop, name='wled-health', daemon=True)
+    _health_thread.start()
+
+
+def compact_leds(led_colors):
+    """Encode a {led: 'RRGGBB'} map as a WLED 'i' list.
+
+    Runs of neighbouring LEDs with the same colour become one [start, stop, colour]
+    range (stop is exclusive), single LEDs stay [index, colour].
+    """
+    compact = []
+    run_start = run_stop = run_color = None
+    for led in sorted(led_colors):
+        color = led_colors[led]
+        if led == run_stop and color == run_color:
+            run_stop += 1
+            continue
+        _append_run(compact, run_start, run_stop, run_color)
+        run_start, run_stop, run_color = led, led + 1, color
+    _append_run(compact, run_start, run_stop, run_color)
+    return compact
+
+
+def _append_run(compact, start, stop, color):
+    if start is None:
+        return
+    if stop - start == 1:
+        compact.extend([start, color])
+    else:
+        compact.extend([start, stop, color])
+
+
+def led_payload(leds, color, on=True):
+    """State update giving the listed LEDs one colour."""
+    return {"on": on, "seg": {"i": compact_leds({led: color.lstrip('#') for led in leds})}}
+
+
+def fill_payload(total_leds, color, on=True):
+    """State update painting the whole strip in one colour with a single range."""
+    return {"on": on, "seg": {"i": [0, total_leds, color.lstrip('#')]}}
+
+
+def frame_payload(total_leds, base_color, led_colors, bri=None):
+    """Complete strip state in one update: the base colour everywhere, then the {led: colour} highlights."""
+    highlights = compact_leds({led: color.lstrip('#') for led, color in led_colors.items()})
+    payload = {"on": True, "seg": {"i": [0, total_leds, base_color.lstrip('#')] + highlights}}
+    if bri is not None:
+        payload["bri"] = bri
+    return payload
+
+
+def set_transports(transports):
+    """Replace the {ip: transport} map, unknown transports fall back to 'http'."""
+    global _transports
+    valid = {}
+    for ip, transport in transports.items():
+        transport = (transport or 'http').lower()
+        if transport not in TRANSPORTS:
+            print(f"Unknown transport '{transport}' for {ip}, using http")
+            transport = 'http'
+        valid[ip] = transport
+    _transports = valid
+
+
+def get_transport(ip):
+    return _transports.get(ip, 'http')
+
+
+def _color_bytes(color):
+    if isinstance(color, (list, tuple)):
+        return bytes(color[:3])
+    try:
+        return bytes.fromhex(color.lstrip('#')[:6])
+    except ValueError:
+        return bytes(3)
+
+
+def render_frame(frame, payload):
+    """Apply a state update that only sets LED colours to an RGB frame buffer.
+
+    Returns False, leaving the frame untouched, when the update does more than that
+    (effects, segment settings, ...) and has to go through the JSON API.
+    """
+    seg = payload.get('seg')
+    if set(payload) - {'on', 'bri', 'seg'} or not isinstance(seg, dict) or set(seg) - {'i'}:
+        return False
+
+    updated = bytearray(frame)
+    if payload.get('on') is False:
+        updated[:] = bytes(len(updated))
+    else:
+        leds = seg.get('i', [])
+        k = 0
+        while k < len(leds):
+            if isinstance(leds[k + 1], int):
+                start, stop, color = leds[k], leds[k + 1], leds[k + 2]
+                k += 3
+            else:
+                start, stop, color = leds[k], leds[k] + 1, leds[k + 1]
+                k += 2
+            stop = min(stop, len(updated) // 3)
+            if start < stop:
+                updated[start * 3:stop * 3] = _color_bytes(color) * (stop - start)
+    frame[:] = updated
+    return True
+
+
+def send_realtime(ip, payload):
+    """Send a colour-only state update as a UDP realtime frame.
+
+    Returns None when the ESP uses the JSON API or the update cannot be expressed as a frame.
+    """
+    transport = get_transport(ip)
+    if transport == 'http':
+        return None
+
+    # The ESP's last frame is kept so partial updates only change their own LEDs
+    state = device_state(ip)
+    total_leds = get_info(ip)['leds']
+    frame = state['frame']
+    if frame is None or len(frame) != total_leds * 3:
+        frame = bytearray(total_leds * 3)
+    if not render_frame(frame, payload):
+        return None
+    state['frame'] = frame
+
+    host = ip.rsplit(':', 1)[0]
+    start = time.monotonic()
+    try:
+        packets = realtime.send_frame(host, frame, transport)
+    except OSError as e:
+        print(f"UDP error for {ip}: {e}")
+        return {'status': 'error', 'error': str(e), 'latency_ms': round((time.monotonic() - start) * 1000, 1)}
+    return {'status': 'ok', 'transport': transport, 'packets': packets,
+            'latency_ms': round((time.monotonic() - start) * 1000, 1)}
+
+
+def _preset_cache(ip):
+    cache = _presets.get(ip)
+    if cache is None:
+        cache = _presets[ip] = {'slots': OrderedDict(), 'hits': OrderedDict()}
+    return cache
+
+
+def preset_lookup(ip, key):
+    """Return the preset id holding the frame key on the ESP, or None."""
+    with _presets_lock:
+        slots = _preset_cache(ip)['slots']
+        entry = slots.get(key)
+        if entry is None:
+            return None
+        slots.move_to_end(key)
+        entry['uses'] += 1
+        return entry['preset']
+
+
+def preset_claim(ip, key, label=None):
+    """Count a locate of the frame key and return the preset id to save it in once it is hot.
+
+    Returns None while the frame has been located fewer than PRESET_MIN_HITS times.
+    When all slots are taken the least recently used preset is overwritten.
+    """
+    with _presets_lock:
+        cache = _preset_cache(ip)
+        slots, hits = cache['slots'], cache['hits']
+        if key in slots:
+            slots.move_to_end(key)
+            return slots[key]['preset']
+
+        hits[key] = hits.pop(key, 0) + 1
+        # Bound the counters, frames that are rarely located are forgotten first
+        while len(hits) > PRESET_SLOTS * 4:
+            hits.popitem(last=False)
+        if hits[key] < PRESET_MIN_HITS or PRESET_SLOTS < 1:
+            return None
+        del hits[key]
+
+        if len(slots) < PRESET_SLOTS:
+            used = {entry['preset'] for entry in slots.values()}
+            preset = next(p for p in range(PRESET_FIRST, PRESET_FIRST + PRESET_SLOTS) if p not in used)
+        else:
+            _, evicted = slots.popitem(last=False)
+            preset = evicted['preset']
+        slots[key] = {'preset': preset, 'label': label, 'uses': 0}
+        return preset
+
+
+def preset_forget(ip, key=None):
+    """Forget one cached frame of an ESP, or all of them when its layout or address changed."""
+    with _presets_lock:
+        if key is None:
+            _presets.pop(ip, None)
+        elif ip in _presets:
+            _presets[ip]['slots'].pop(key, None)
+
+
+def preset_stats():
+    """Preset id, label and recall count of the cached frames per ESP, most recently used last."""
+    with _presets_lock:
+        return {
+            ip: [{'preset': entry['preset'], 'label': entry['label'], 'uses': entry['uses']}
+                 for entry in cache['slots'].values()]
+            for ip, cache in _presets.items()
+        }
+
+
+def schedule(ip, delay, callback):
+    """Run callback() after delay seconds, replacing the command still pending for the same ESP."""
+    timer = threading.Timer(delay, _run_scheduled, args=(ip, callback))
+    timer.daemon = True
+    with _timers_lock:
+        previous = _timers.get(ip)
+        if previous is not None:
+            previous.cancel()
+        _timers[ip] = timer
+    timer.start()
+
+
+def cancel_scheduled(ip):
+    """Cancel the pending delayed command of an ESP, returns True if there was one."""
+    with _timers_lock:
+        timer = _timers.pop(ip, None)
+    if timer is None:
+        return False
+    timer.cancel()
+    return True
+
+
+def _run_scheduled(ip, callback):
+    with _timers_lock:
+        # Skip when the command was replaced right before the timer fired
+        if _timers.get(ip) is not threading.current_thread():
+            return
+        del _timers[ip]
+    # Run through the ESP's queue so it never interleaves with a locate, without dropping waiting commands
+    submit(ip, callback, coalesce=False)
+
+
+def shutdown():
+    global _stopping
+    _stopping = True
+    _health_wakeup.set()
+    with _devices_lock:
+        for device in _devices.values():
+            with device['condition']:
+                device['condition'].notify_all()
+    with _timers_lock:
+        for timer in _timers.values():
+            timer.cancel()
+        _timers.clear()
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+    _executor.shutdown(wait=False, cancel_futures=True)